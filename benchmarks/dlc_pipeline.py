@@ -0,0 +1,145 @@
+"""
+Compares making the videos and then running DLC over the whole corpus against tools.DlcScheduler, which
+runs DLC on each batch of finished videos while the next ones are rendered, and against the frames
+backend, which hands DLC the frames in memory without writing videos. DLC is stood in for by the
+synthetic corpus' analyze_videos and StubPoseEstimator, slowed down to a given model load time per call
+and inference time per frame, which sleep as a GPU would leave the CPU free. Each run starts from empty
+video folders. The frames given to the estimator are also compared with the frames of the videos, and the
+script exits with an error if they differ by more than the video encoding explains.
+python -m benchmarks.dlc_pipeline --utterances 16 --ms-per-frame 4
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+import numpy
+from benchmarks import synthetic_corpus
+from tools.config_manager import config
+from tools.UtteranceController import UtteranceController
+from tools import io as myio
+
+# grey levels by which the frames given to DLC may differ from those of the videos, on average and at most,
+# as the videos are encoded with -crf 10; frames laid out differently to the videos differ by far more
+MEAN_TOLERANCE = 2.0
+MAX_TOLERANCE = 64
+
+
+def slow_analyzer(load_seconds, ms_per_frame):
+    """ analyze_videos, taking as long as DLC would to load its model and to run on every frame """
+    def analyze_videos(dlc_config, videos, shuffle=0, save_as_csv=True):
+        time.sleep(load_seconds)
+        paths = videos if not isinstance(videos, str) else [os.path.join(videos, name)
+                                                             for name in os.listdir(videos) if name.endswith('.mp4')]
+        frames = sum(myio.probe_video(path[:-len('.mp4')])['nframes'] for path in paths)
+        time.sleep(frames * ms_per_frame / 1000)
+        synthetic_corpus.analyze_videos(dlc_config, videos, shuffle, save_as_csv)
+    return analyze_videos
+
+
+class SlowEstimator(synthetic_corpus.StubPoseEstimator):
+    """ StubPoseEstimator, taking as long as DLC would on every frame; its model is loaded once """
+    def __init__(self, folder, load_seconds, ms_per_frame):
+        super().__init__(folder)
+        time.sleep(load_seconds)
+        self.ms_per_frame = ms_per_frame
+
+    def estimate(self, frames):
+        time.sleep(frames.shape[0] * self.ms_per_frame / 1000)
+        return super().estimate(frames)
+
+
+def compare_frames(corpus, output):
+    """
+    Mean and largest absolute difference between the frames laid out in memory and those decoded from the videos,
+    of the first utterance in the output folder, for the ultrasound and the lips
+    """
+    from tools.VideoMaker import VideoMaker
+    us_folder, lip_folder = os.path.join(output, 'USVideo'), os.path.join(output, 'LipVideo')
+    utt_id = sorted(name[:-len('.mp4')] for name in os.listdir(lip_folder) if name.endswith('.mp4'))[0]
+    video_maker = VideoMaker(us_folder, lip_folder)
+    video_maker.keep_frames = True
+    video_maker.write_videos = False
+    video_maker.probe_streams(os.path.join(corpus, 'core', *utt_id.split('-')))
+    video_maker.trim_to_parallel_streams()
+    video_maker.read_streams(os.path.join(corpus, 'core', *utt_id.split('-')))
+    video_maker.downsample()
+    video_maker.manipulate_ultrasound()
+    results = {}
+    for name, frames, origin, folder in [('ultrasound', video_maker.ult_temp, 'lower', us_folder),
+                                         ('lip', video_maker.vid_temp, 'upper', lip_folder)]:
+        laid_out = video_maker.layout_frames(frames, origin)
+        decoded, _ = myio.read_video(os.path.join(folder, utt_id), shape='3d')
+        difference = numpy.abs(laid_out[:len(decoded)].astype(numpy.float32) - decoded[:len(laid_out)])
+        results[name] = len(laid_out), len(decoded), difference.mean(), difference.max()
+    return results
+
+
+def run(corpus, output, mode, analyzer, estimators):
+    """ Makes the videos and CSVs of the corpus under output, returning the seconds taken and the utterances done """
+    config.set('Paths', 'tal_path', os.path.join(corpus, 'core'))
+    config.set('Paths', 'video_and_csv_path', output)
+    config.set('Paths', 'corpus_manifest', os.path.join(output, 'corpus_manifest.txt'))
+    config.set('DLC', 'backend', 'frames' if mode == 'frames' else 'videos')
+    config.set('PreDLC', 'write_videos', str(mode != 'frames'))
+    controller = UtteranceController()
+    controller.dlc_analyzer = analyzer
+    controller.pose_estimators = estimators
+    controller.make_utts()
+    controller.make_sets()
+    start = time.perf_counter()
+    if mode != 'sequential':
+        controller.make_videos_with_dlc()
+    else:
+        controller.make_videos()
+        controller.run_dlc()
+    elapsed = time.perf_counter() - start
+    done = sum(controller.manifest.is_done('dlc', utt.id) for utt in controller.utterance_list)
+    return elapsed, done, len(controller.utterance_list)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--utterances', type=int, default=16)
+    parser.add_argument('--seconds', type=float, default=2.0)
+    parser.add_argument('--video-workers', type=int, default=2)
+    parser.add_argument('--batch-size', type=int, default=4)
+    parser.add_argument('--load-seconds', type=float, default=1.0, help='time DLC takes to load its models')
+    parser.add_argument('--ms-per-frame', type=float, default=4.0, help='time DLC takes per frame')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        corpus = os.path.join(temp_dir, 'corpus')
+        print(f'Writing {args.utterances} synthetic utterances...')
+        synthetic_corpus.make_corpus(corpus, args.utterances, seconds=args.seconds)
+        config.set('Paths', 'DLC_project', os.path.join(temp_dir, 'dlc'))
+        config.set('PreDLC', 'video_workers', str(args.video_workers))
+        config.set('DLC', 'batch_size', str(args.batch_size))
+        analyzer = slow_analyzer(args.load_seconds, args.ms_per_frame)
+
+        results = {}
+        for mode in ['sequential', 'pipelined', 'frames']:
+            estimators = None
+            if mode == 'frames':
+                estimators = tuple(SlowEstimator(folder, args.load_seconds, args.ms_per_frame)
+                                   for folder in ['USVideo', 'LipVideo'])
+            results[mode] = run(corpus, os.path.join(temp_dir, mode), mode, analyzer, estimators)
+        comparisons = compare_frames(corpus, os.path.join(temp_dir, 'pipelined'))
+
+    for mode, (elapsed, done, total) in results.items():
+        print(f'{mode}: {elapsed:.1f}s ({results["sequential"][0] / elapsed:.2f}x), '
+              f'{done}/{total} utterances with both CSVs')
+    failures = []
+    for name, (laid_out, decoded, mean, largest) in comparisons.items():
+        print(f'{name} frames in memory: {laid_out}, in the video: {decoded}, '
+              f'grey levels differ by {mean:.2f} on average and {largest:.0f} at most')
+        if laid_out != decoded or mean > MEAN_TOLERANCE or largest > MAX_TOLERANCE:
+            failures.append(name)
+    if failures:
+        sys.exit(f'The {" and ".join(failures)} frames given to DLC differ from the videos by more than '
+                 f'{MEAN_TOLERANCE} grey levels on average or {MAX_TOLERANCE} at most, or in number')
+
+
+if __name__ == '__main__':
+    main()
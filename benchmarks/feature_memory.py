@@ -0,0 +1,98 @@
+"""
+Measures the memory used to hold a corpus' features until the Kaldi files are written: the plain utterance
+objects used before, which kept their lip, US and combined float64 arrays, against slotted utterances
+whose combined features go into one float32 tools.FeatureStore buffer. Each layout is built in a fresh
+process, so the peak RSS of one does not hide the other's, and the features are checked to agree.
+python -m benchmarks.feature_memory --utterances 5000
+"""
+
+import argparse
+import multiprocessing
+import resource
+import sys
+import time
+import tracemalloc
+import numpy
+from sklearn.preprocessing import StandardScaler
+from tools.FeatureStore import FeatureStore
+from tools.Utterance import Utterance
+
+# DLC frame index plus x and y of each body part
+LIP_COLUMNS = 1 + 2 * 8
+US_COLUMNS = 1 + 2 * 14
+
+
+class LegacyUtterance:
+    """ The utterance object as it was before slots and the feature store """
+    def __init__(self, id, modality, text, base_path):
+        self.id = id
+        self.modality = modality
+        self.split = ''
+        self.text = text
+        [self.speaker, self.utt_id] = id.split('-')
+        self.gender = self.speaker[2]
+        self.duration = None
+        self.base_path = base_path
+        self.lip_features = []
+        self.us_features = []
+        self.combined_feats = None
+        self.discarded = False
+
+    def feature_combiner(self):
+        if len(self.lip_features) and len(self.us_features):
+            matrix = numpy.concatenate([self.lip_features, self.us_features], axis=1)
+            matrix = numpy.vstack(matrix).astype(float)
+            self.combined_feats = StandardScaler().fit_transform(matrix)
+        else:
+            self.discarded = True
+
+
+def synthetic_features(index, rng):
+    frames = int(rng.integers(120, 600))
+    return rng.normal(size=(frames, LIP_COLUMNS)), rng.normal(size=(frames, US_COLUMNS))
+
+
+def build(layout, num_utterances):
+    """ Builds the corpus in one layout, returning peak RSS, peak and held traced memory in MB, time and a checksum """
+    tracemalloc.start()
+    start = time.perf_counter()
+    rng = numpy.random.default_rng(0)
+    store = FeatureStore()
+    utterances = []
+    for i in range(num_utterances):
+        cls = LegacyUtterance if layout == 'legacy' else Utterance
+        utterance = cls(f'{i // 1000:02d}fi-{i % 1000:03d}_aud', 'modal', 'text\n', None)
+        utterance.lip_features, utterance.us_features = synthetic_features(i, rng)
+        utterance.feature_combiner()
+        if layout == 'store':
+            utterance.store_features(store)
+        utterances.append(utterance)
+    store.trim()
+    elapsed = time.perf_counter() - start
+    held, traced = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    checksum = float(sum(numpy.float32(utterance.combined_feats).sum(dtype=numpy.float64) for utterance in utterances))
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 if sys.platform != 'darwin' else 1024 ** 2)
+    return rss, traced / 2 ** 20, held / 2 ** 20, elapsed, checksum
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--utterances', type=int, default=5000)
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context('spawn')
+    results = {}
+    for layout in ['legacy', 'store']:
+        with context.Pool(1) as pool:
+            results[layout] = pool.apply(build, (layout, args.utterances))
+        rss, traced, held, elapsed, _ = results[layout]
+        print(f'{layout}: peak RSS {rss:.0f} MB, peak traced {traced:.0f} MB, held {held:.0f} MB, '
+              f'built in {elapsed:.1f}s')
+    legacy, store = results['legacy'], results['store']
+    print(f'peak RSS {legacy[0] / store[0]:.1f}x lower, features held {legacy[2] / store[2]:.1f}x smaller, '
+          f'checksum difference {abs(legacy[4] - store[4]):.2e}')
+
+
+if __name__ == '__main__':
+    main()
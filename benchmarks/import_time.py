@@ -0,0 +1,62 @@
+"""
+Measures the time and memory it takes to import each entry point and tool module, each in a fresh interpreter,
+and which heavy dependencies (DLC, torch, matplotlib, sklearn, nltk) come with it. The features-only path must
+not import any of them; with --check, the script exits with an error if it does, to catch regressions.
+python -m benchmarks.import_time --check
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+
+HEAVY = ['deeplabcut', 'torch', 'matplotlib', 'sklearn', 'nltk', 'tensorflow']
+MODULES = ['features_setup', 'main_setup', 'tools.UtteranceController', 'tools.FeatureMaker', 'tools.KaldiFileMaker',
+           'tools.Utterance', 'tools.VideoMaker']
+# what running features_setup.py imports before any features are made
+FEATURES_ONLY = ['features_setup', 'tools.UtteranceController', 'tools.FeatureMaker', 'tools.KaldiFileMaker',
+                 'tools.Utterance']
+
+PROBE = '''
+import importlib, json, resource, sys, time
+start = time.perf_counter()
+importlib.import_module({module!r})
+elapsed = time.perf_counter() - start
+print(json.dumps({{'seconds': elapsed, 'rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                  'heavy': [name for name in {heavy!r} if name in sys.modules]}}))
+'''
+
+
+def probe(module):
+    """ Imports a module in a fresh interpreter, returning its import time, peak RSS and heavy imports """
+    result = subprocess.run([sys.executable, '-c', PROBE.format(module=module, heavy=HEAVY)],
+                            capture_output=True, text=True)
+    if result.returncode:
+        return {'error': result.stderr.strip().splitlines()[-1]}
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--check', action='store_true', help='fail if the features-only path imports heavy modules')
+    args = parser.parse_args()
+
+    failures = []
+    print(f'{"module":<30}{"import s":>10}{"RSS MB":>10}  heavy imports')
+    for module in MODULES:
+        result = probe(module)
+        if 'error' in result:
+            print(f'{module:<30}  could not be imported: {result["error"]}')
+            if module in FEATURES_ONLY:
+                failures.append(module)
+            continue
+        print(f'{module:<30}{result["seconds"]:>10.2f}{result["rss_mb"]:>10.0f}  {" ".join(result["heavy"]) or "-"}')
+        if module in FEATURES_ONLY and result['heavy']:
+            failures.append(module)
+
+    if args.check and failures:
+        sys.exit(f'The features-only path imports heavy dependencies, or fails to import: {" ".join(failures)}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""
+Checks that the features written by tools.kaldi_io.KaldiArkWriter are what Kaldi reads: random float32 (and
+float64, as for CMVN statistics) matrices are written under unsorted keys, then read back through read_ark and
+through the scp with read_scp, and must come back equal, with the scp sorted by key. The bytes of the first
+matrix are also checked against Kaldi's binary layout directly: key and space, "\\0B", the "FM " token, then
+rows and columns each as a size byte of 4 and a little-endian int32, at the byte offset given in the scp.
+Also times the write and both reads. The script exits with an error if any check fails.
+python -m benchmarks.kaldi_roundtrip --utterances 200
+"""
+
+import argparse
+import os
+import struct
+import sys
+import tempfile
+import time
+import numpy
+from tools import kaldi_io
+
+
+def make_matrices(utterances, dims, seed=0):
+    """ Random matrices of varied lengths, keyed so that the order written is not the sorted order """
+    rng = numpy.random.default_rng(seed)
+    keys = [f'{index % 7:02d}spk-{index:03d}_aud' for index in range(utterances)]
+    rng.shuffle(keys)
+    return {key: rng.standard_normal((int(rng.integers(1, 300)), dims)).astype(numpy.float32) for key in keys}
+
+
+def check_layout(ark_path, scp_path, key, matrix):
+    """ The failures found by reading the first matrix's bytes as Kaldi lays them out, without kaldi_io """
+    failures = []
+    with open(ark_path, 'rb') as f:
+        data = f.read(len(key) + 1 + 15 + matrix.nbytes)
+    if data[:len(key) + 1] != key.encode('utf-8') + b' ':
+        failures.append('the ark does not start with the first key and a space')
+    offset = len(key) + 1
+    with open(scp_path, 'r') as f:
+        scp_offsets = dict(line.split() for line in f)
+    if scp_offsets.get(key) != f'{ark_path}:{offset}':
+        failures.append(f'the scp gives {scp_offsets.get(key)} for {key}, not {ark_path}:{offset}')
+    header = data[offset:offset + 15]
+    if header[:5] != b'\0BFM ' or header[5:6] != b'\4' or header[10:11] != b'\4':
+        failures.append(f'the matrix header is {header!r}')
+    elif (struct.unpack('<i', header[6:10])[0], struct.unpack('<i', header[11:15])[0]) != matrix.shape:
+        failures.append(f'the matrix dims are not {matrix.shape}')
+    if data[offset + 15:] != matrix.astype('<f4').tobytes():
+        failures.append('the matrix data is not little-endian float32 in row order')
+    return failures
+
+
+def compare(name, expected, read):
+    """ The failures found comparing the matrices read back with those written """
+    failures = []
+    if set(read) != set(expected):
+        failures.append(f'{name} read {len(read)} keys, {len(set(read) ^ set(expected))} of them differing')
+    for key, matrix in read.items():
+        if key in expected and (matrix.dtype != expected[key].dtype or not numpy.array_equal(matrix, expected[key])):
+            failures.append(f'{name} read {key} back differently')
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--utterances', type=int, default=200)
+    parser.add_argument('--dims', type=int, default=46)
+    args = parser.parse_args()
+
+    matrices = make_matrices(args.utterances, args.dims)
+    rng = numpy.random.default_rng(1)
+    stats = {key: rng.standard_normal((2, args.dims + 1)) for key in list(matrices)[:5]}
+    failures = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        ark_path, scp_path = os.path.join(temp_dir, 'feats.ark'), os.path.join(temp_dir, 'feats.scp')
+        start = time.perf_counter()
+        with kaldi_io.KaldiArkWriter(ark_path, scp_path) as writer:
+            for key, matrix in matrices.items():
+                writer.write(key, matrix)
+        write_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        from_ark = list(kaldi_io.read_ark(ark_path))
+        ark_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        from_scp = list(kaldi_io.read_scp(scp_path))
+        scp_seconds = time.perf_counter() - start
+
+        if [key for key, _ in from_ark] != list(matrices):
+            failures.append('read_ark does not give the matrices in the order they were written')
+        if [key for key, _ in from_scp] != sorted(matrices):
+            failures.append('the scp is not sorted by key')
+        failures += compare('read_ark', matrices, dict(from_ark))
+        failures += compare('read_scp', matrices, dict(from_scp))
+        first_key = next(iter(matrices))
+        failures += check_layout(ark_path, scp_path, first_key, matrices[first_key])
+
+        cmvn_ark, cmvn_scp = os.path.join(temp_dir, 'cmvn.ark'), os.path.join(temp_dir, 'cmvn.scp')
+        with kaldi_io.KaldiArkWriter(cmvn_ark, cmvn_scp) as writer:
+            for key, matrix in stats.items():
+                writer.write(key, matrix, double=True)
+        failures += compare('read_scp of double matrices', stats, dict(kaldi_io.read_scp(cmvn_scp)))
+        ark_mb = os.path.getsize(ark_path) / 2 ** 20
+
+    print(f'{len(matrices)} matrices, {ark_mb:.1f} MB: written in {write_seconds:.3f}s, '
+          f'read from the ark in {ark_seconds:.3f}s and through the scp in {scp_seconds:.3f}s')
+    if failures:
+        sys.exit('The Kaldi archives do not round trip:\n' + '\n'.join(failures))
+    print('Every matrix read back equal through the ark and the scp, and the scp is sorted')
+
+
+if __name__ == '__main__':
+    main()
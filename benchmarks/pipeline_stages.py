@@ -0,0 +1,137 @@
+"""
+Times each stage of the pipeline on a synthetic TaL corpus (see benchmarks.synthetic_corpus), CPU-only and
+with the CSVs DLC would make generated by the corpus, so regressions show up before a production run.
+Every stage runs over all the utterances for its time, then once more on the largest input under
+tracemalloc for its peak memory. The media stages (io.read_video, utils.resize, transform_ultrasound)
+run on the utterances which have media, the feature and Kaldi stages on all of them.
+python -m benchmarks.pipeline_stages --utterances 100 --media 10
+"""
+
+import argparse
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+import numpy
+from benchmarks import synthetic_corpus
+from tools import io as myio
+from tools import utils
+from tools.transform_ultrasound import transform_ultrasound, get_scan_converter
+from tools.FeatureMaker import FeatureMaker
+from tools.KaldiFileMaker import KaldiFileMaker
+from tools.PoseCache import PoseCache
+from tools.Utterance import Utterance
+from tools.UtteranceController import TONGUE_ANATOMY, LIP_ANATOMY
+from tools.VideoMaker import US_REGION
+
+TARGET_FPS = 60
+
+
+def measure(function, calls):
+    """
+    Runs function over every argument tuple for the time, then on the largest one under tracemalloc.
+    @return: dict of the number of calls, total seconds and peak MB of the largest call
+    """
+    start = time.perf_counter()
+    for args in calls:
+        function(*args)
+    elapsed = time.perf_counter() - start
+
+    largest = max(calls, key=lambda args: sum(getattr(arg, 'nbytes', 0) for arg in args))
+    tracemalloc.start()
+    function(*largest)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'calls': len(calls), 'seconds': elapsed, 'peak_mb': peak / 2 ** 20}
+
+
+def ultrasound_geometry(params):
+    return dict(background_colour=0, num_scanlines=int(params['NumVectors']), size_scanline=int(params['PixPerVector']),
+                angle=float(params['Angle']), zero_offset=int(params['ZeroOffset']), pixels_per_mm=3)
+
+
+def make_kaldi_split(data_dir, utterances):
+    kaldi_file_maker = KaldiFileMaker()
+    kaldi_file_maker.data_dir = data_dir
+    kaldi_file_maker.make_kaldi_files(utterances, 'train')
+
+
+def combine(utterance, lip_features, us_features):
+    utterance.lip_features, utterance.us_features = lip_features, us_features
+    utterance.feature_combiner()
+
+
+def run_stages(corpus, media_ids, all_ids):
+    """ Prepares the inputs of each stage outside the timings, and measures them stage by stage """
+    results = {}
+    if not media_ids:
+        print('No utterances have media, skipping the media stages')
+    base_paths = [os.path.join(corpus, 'core', *utt_id.split('-')) for utt_id in media_ids]
+
+    ultrasound = [myio.read_ultrasound_frames(path) for path in base_paths]
+    if ultrasound:
+        results['io.read_video'] = measure(lambda path: myio.read_video(path), [(path,) for path in base_paths])
+        resize_calls = [(ult, int(ult.shape[0] * TARGET_FPS / params['FramesPerSec'])) for ult, params in ultrasound]
+        results['utils.resize'] = measure(lambda ult, frames: utils.resize(ult, frames, dtype=numpy.uint8),
+                                          resize_calls)
+        geometry = ultrasound_geometry(ultrasound[0][1])
+        results['transform_ultrasound'] = measure(lambda ult: transform_ultrasound(ult, **geometry),
+                                                  [(ult,) for ult, _ in ultrasound])
+        # as VideoMaker converts it, cropped and straight to uint8
+        scan_converter = get_scan_converter(region=US_REGION, **geometry)
+        results['ScanConverter (VideoMaker)'] = measure(lambda ult: scan_converter.convert(ult, dtype=numpy.uint8),
+                                                        [(ult,) for ult, _ in ultrasound])
+
+    features = {}
+    for folder, anatomy in [('USVideo', TONGUE_ANATOMY), ('LipVideo', LIP_ANATOMY)]:
+        feature_maker = FeatureMaker(os.path.join(corpus, 'features', folder), anatomy, '')
+        feature_maker.index_csvs()
+        poses = [PoseCache.read_csv(feature_maker.csv_index[utt_id]) for utt_id in all_ids]
+        calls = [(data, columns) for columns, data in poses]
+        results[f'FeatureMaker.feature_maker ({folder})'] = measure(feature_maker.feature_maker, calls)
+        features[folder] = []
+        for data, columns in calls:
+            feature_maker.feature_maker(data, columns)
+            features[folder].append(feature_maker.features)
+
+    utterances = [Utterance(utt_id, 'modal', 'text\n', None) for utt_id in all_ids]
+    results['Utterance.feature_combiner'] = measure(
+        combine, list(zip(utterances, features['LipVideo'], features['USVideo'])))
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        results['KaldiFileMaker.make_kaldi_files'] = measure(make_kaldi_split, [(data_dir, utterances)])
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--utterances', type=int, default=100)
+    parser.add_argument('--media', type=int, default=10, help='utterances with .ult, .wav and .mp4')
+    parser.add_argument('--seconds', type=float, default=2.0)
+    parser.add_argument('--corpus', help='an existing synthetic corpus to use instead of writing a new one')
+    parser.add_argument('--json', help='also write the results to this file, e.g. to compare runs')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        corpus = args.corpus or temp_dir
+        if args.corpus is None:
+            print(f'Writing {args.utterances} synthetic utterances...')
+            synthetic_corpus.make_corpus(corpus, args.utterances, seconds=args.seconds, media=args.media)
+        with open(os.path.join(corpus, 'features', 'all_text'), 'r') as f:
+            all_ids = [line.split(' ', 1)[0] for line in f]
+        media_ids = [utt_id for utt_id in all_ids
+                     if os.path.isfile(os.path.join(corpus, 'core', *utt_id.split('-')) + '.ult')]
+        results = run_stages(corpus, media_ids, all_ids)
+
+    print(f'{"stage":<40}{"calls":>7}{"total s":>10}{"ms/call":>10}{"peak MB":>10}')
+    for stage, result in results.items():
+        per_call = 1000 * result['seconds'] / max(result['calls'], 1)
+        print(f'{stage:<40}{result["calls"]:>7}{result["seconds"]:>10.2f}{per_call:>10.1f}{result["peak_mb"]:>10.1f}')
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
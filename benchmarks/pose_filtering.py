@@ -0,0 +1,93 @@
+"""
+Compares the vectorised tools.pose_filters engine against the per-column pandas filtering
+FeatureMaker used before, on synthetic DLC tables: checks the features agree and times both,
+per utterance and for a whole corpus.
+python -m benchmarks.pose_filtering --utterances 200
+"""
+
+import argparse
+import statistics
+import time
+import numpy
+import pandas
+import scipy.signal as sig
+from tools import pose_filters
+from tools.UtteranceController import TONGUE_ANATOMY
+
+LIKELIHOOD_CUTOFF = .1
+OUTLIER_CUTOFF = 3
+LOWPASS_CUTOFF = 20
+
+
+def legacy_feature_maker(features, anatomy):
+    """ The pandas filtering FeatureMaker.feature_maker did before tools.pose_filters """
+    for part in anatomy:
+        for coordinate in ['x', 'y']:
+            features[(part, coordinate)] = features[(part, coordinate)].where(
+                features[(part, 'likelihood')] > LIKELIHOOD_CUTOFF, other=numpy.nan)
+    features = features.interpolate(axis=0, limit_direction='both')
+    for part in anatomy:
+        for coordinate in ['x', 'y']:
+            column = features[(part, coordinate)]
+            std = statistics.stdev(column)
+            mean = statistics.mean(column)
+            features[(part, coordinate)] = column.where((column < mean + (std * OUTLIER_CUTOFF)) &
+                                                        (column > mean - (std * OUTLIER_CUTOFF)), other=numpy.nan)
+    features = features.interpolate(axis=0, limit_direction='both')
+    sos = sig.butter(3, LOWPASS_CUTOFF, output='sos', fs=60)
+    for part in anatomy:
+        for coordinate in ['x', 'y']:
+            prefix = features[(part, coordinate)][(features.index < 15)]
+            total = pandas.concat([prefix, features[(part, coordinate)]], axis=0)
+            features[(part, coordinate)] = sig.sosfilt(sos, total)[15:]
+    features = features.drop([(part, 'likelihood') for part in anatomy], axis=1)
+    if features.isnull().values.any():
+        features = pandas.DataFrame()
+    return features.to_numpy()
+
+
+def synthetic_table(num_frames, anatomy, rng):
+    """ A DLC table as pandas reads it from the CSV, with a few unlikely frames and outliers """
+    t = numpy.arange(num_frames) / 60
+    data = {('bodyparts', 'coords'): numpy.arange(num_frames)}
+    for part in anatomy:
+        for coordinate in ['x', 'y']:
+            trajectory = 200 + 30 * numpy.sin(2 * numpy.pi * rng.uniform(1, 6) * t + rng.uniform(0, 6))
+            trajectory += rng.normal(0, 2, num_frames)
+            outliers = rng.random(num_frames) < 0.01
+            trajectory[outliers] += rng.normal(0, 200, outliers.sum())
+            data[(part, coordinate)] = trajectory
+        data[(part, 'likelihood')] = numpy.clip(rng.normal(0.9, 0.3, num_frames), 0, 1)
+    return pandas.DataFrame(data)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--utterances', type=int, default=200)
+    args = parser.parse_args()
+
+    rng = numpy.random.default_rng(0)
+    tables = [synthetic_table(int(rng.integers(120, 600)), TONGUE_ANATOMY, rng) for _ in range(args.utterances)]
+
+    legacy_time, engine_time, max_difference = 0, 0, 0
+    for table in tables:
+        start = time.perf_counter()
+        reference = legacy_feature_maker(table.copy(), TONGUE_ANATOMY)
+        legacy_time += time.perf_counter() - start
+
+        start = time.perf_counter()
+        features = pose_filters.filter_poses(table.to_numpy(dtype=numpy.float64), list(table.columns),
+                                             TONGUE_ANATOMY, LIKELIHOOD_CUTOFF, OUTLIER_CUTOFF, LOWPASS_CUTOFF)
+        engine_time += time.perf_counter() - start
+
+        assert reference.shape == features.shape
+        if features.size:
+            max_difference = max(max_difference, numpy.abs(reference - features).max())
+
+    print(f"pandas: {1000 * legacy_time / len(tables):.2f} ms/utterance, {legacy_time:.2f}s for the corpus")
+    print(f"pose_filters: {1000 * engine_time / len(tables):.2f} ms/utterance, {engine_time:.2f}s for the corpus")
+    print(f"max abs difference: {max_difference}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""
+Compares tools.utils.resample_frames against the skimage.transform.resize call it replaced,
+on smooth synthetic streams at the TaL frame rates (ultrasound ~81.5 fps, lip video 60 fps,
+both to 60 fps), checking the outputs agree and timing both.
+python -m benchmarks.resample --seconds 10
+"""
+
+import argparse
+import time
+import numpy
+import skimage.transform
+from tools.utils import resample_frames
+
+STREAMS = {'ultrasound': (81.5, (64, 842)), 'lip': (60, (240, 320))}
+TARGET_FPS = 60
+
+
+def skimage_resize(data, target_frames):
+    """ The previous tools.utils.resize """
+    num_frames = data.shape[0]
+    x, y = data.shape[1], data.shape[2]
+    resized = skimage.transform.resize(data.reshape(num_frames, -1), output_shape=(target_frames, x * y), order=1,
+                                       mode='edge', clip=True, preserve_range=True, anti_aliasing=True)
+    return resized.reshape(-1, x, y)
+
+
+def smooth_stream(num_frames, frame_shape, rng):
+    """ Sinusoids in time with a random phase per pixel """
+    phase = rng.random(frame_shape) * 2 * numpy.pi
+    t = numpy.arange(num_frames).reshape(-1, 1, 1) / 20.0
+    return (127.5 + 100 * numpy.sin(t + phase)).astype(numpy.uint8)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--seconds', type=float, default=10)
+    args = parser.parse_args()
+
+    rng = numpy.random.default_rng(0)
+    for name, (fps, frame_shape) in STREAMS.items():
+        data = smooth_stream(int(args.seconds * fps), frame_shape, rng)
+        target_frames = int(data.shape[0] * TARGET_FPS / fps)
+
+        start = time.perf_counter()
+        reference = skimage_resize(data, target_frames)
+        skimage_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        resampled = resample_frames(data, target_frames)
+        resample_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        resample_frames(data, target_frames, dtype=numpy.uint8)
+        uint8_time = time.perf_counter() - start
+
+        print(f"{name}: skimage {data.shape[0] / skimage_time:.1f} fps, resample_frames "
+              f"{data.shape[0] / resample_time:.1f} fps (float32), {data.shape[0] / uint8_time:.1f} fps (uint8), "
+              f"max abs difference {numpy.abs(reference - resampled).max():.2e}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+"""
+Compares frames/sec of transform_ultrasound against the cached ScanConverter, on random
+data with the usual TaL probe geometry, and checks that the outputs agree.
+Also times the cropped uint8 conversion VideoMaker uses.
+python -m benchmarks.scan_conversion --frames 200
+"""
+
+import argparse
+import time
+import numpy
+from tools.transform_ultrasound import transform_ultrasound, get_scan_converter
+from tools.VideoMaker import US_REGION
+
+TAL_GEOMETRY = dict(background_colour=0, num_scanlines=64, size_scanline=842, angle=0.0383, zero_offset=210,
+                    pixels_per_mm=3)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--frames', type=int, default=200)
+    args = parser.parse_args()
+
+    rng = numpy.random.default_rng(0)
+    ult = (rng.random((args.frames, TAL_GEOMETRY['num_scanlines'], TAL_GEOMETRY['size_scanline'])) * 255)
+    ult = ult.astype(numpy.uint8)
+
+    start = time.perf_counter()
+    reference = transform_ultrasound(ult, **TAL_GEOMETRY)
+    reference_fps = args.frames / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    scan_converter = get_scan_converter(**TAL_GEOMETRY)
+    build_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    converted = scan_converter(ult)
+    cached_fps = args.frames / (time.perf_counter() - start)
+
+    cropped_converter = get_scan_converter(region=US_REGION, **TAL_GEOMETRY)
+    start = time.perf_counter()
+    cropped = cropped_converter.convert(ult, dtype=numpy.uint8)
+    cropped_fps = args.frames / (time.perf_counter() - start)
+
+    print(f"transform_ultrasound: {reference_fps:.1f} fps")
+    print(f"ScanConverter: {cached_fps:.1f} fps (built once in {build_time:.2f}s)")
+    print(f"ScanConverter, cropped to uint8: {cropped_fps:.1f} fps, {cropped.nbytes / converted.nbytes:.1%} of the memory")
+    print(f"max abs difference: {numpy.abs(reference - converted).max()}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,224 @@
+"""
+Writes a synthetic TaL corpus, so the pipeline can be run and measured without the real corpus or DLC.
+Each utterance gets what TaL80/core has: a .param with the usual probe geometry, raw .ult echo data with
+a moving tongue contour, a 48kHz .wav, a small grayscale lip .mp4 and a .txt prompt. Alongside, the
+features folder gets the CSVs DLC would make for the tongue and lip anatomy, and an all_text file.
+Half of the utterances are silent, and a quarter of the prompts are shared between modalities, so
+every split has utterances in it. Media can be limited to the first utterances to generate large
+corpora quickly, as only the CSVs are needed past DLC.
+python -m benchmarks.synthetic_corpus /tmp/tal_synthetic --utterances 100
+"""
+
+import argparse
+import importlib.util
+import os
+import sys
+import types
+import numpy
+import imageio_ffmpeg
+import scipy.io.wavfile as wavfile
+from tools.PoseCache import PoseCache
+from tools.UtteranceController import TONGUE_ANATOMY, LIP_ANATOMY
+
+
+def analyze_videos(dlc_config, videos, shuffle=0, save_as_csv=True):
+    """
+    Stands in for deeplabcut.analyze_videos, so the pipeline can run CPU-only: writes a synthetic CSV for
+    every video, or every video in the folder, which does not have one yet.
+    """
+    from tools import io as myio
+    anatomy = LIP_ANATOMY if os.path.basename(os.path.dirname(dlc_config)) == 'Lips' else TONGUE_ANATOMY
+    scorer = SCORERS['LipVideo' if anatomy is LIP_ANATOMY else 'USVideo'].replace('shuffle0', f'shuffle{shuffle}')
+    if isinstance(videos, str):
+        videos = [os.path.join(videos, name) for name in sorted(os.listdir(videos)) if name.endswith('.mp4')]
+    rng = numpy.random.default_rng(0)
+    for video in videos:
+        csv_file = video[:-len('.mp4')] + scorer + '.csv'
+        if not os.path.exists(csv_file):
+            write_dlc_csv(csv_file, anatomy, myio.probe_video(video[:-len('.mp4')])['nframes'], rng)
+
+
+def stub_deeplabcut():
+    """
+    Registers analyze_videos as DLC when it is not installed, for the rest of the process. It is opt-in, so
+    importing this module never shadows DLC; the benchmarks pass analyze_videos to the pipeline instead.
+    """
+    if importlib.util.find_spec('deeplabcut') is None:
+        sys.modules['deeplabcut'] = types.SimpleNamespace(analyze_videos=analyze_videos)
+
+# the probe geometry of the TaL recordings
+PARAMS = {'NumVectors': 64, 'PixPerVector': 842, 'ZeroOffset': 210, 'BitsPerPixel': 8, 'Angle': 0.0383,
+          'Kind': 0, 'PixelsPerMm': 10.0, 'FramesPerSec': 81.5, 'TimeInSecsOfFirstFrame': 0.2}
+ULTRASOUND_OVERRUN = 0.1  # seconds
+WAV_RATE = 48000
+VIDEO_FPS = 60
+VIDEO_SIZE = (320, 240)  # width, height
+DLC_FPS = 60
+SCORERS = {'USVideo': 'DLC_resnet50_SpeechProductionFeb12shuffle0_1030000',
+           'LipVideo': 'DLC_resnet50_TaL_LipsJan28shuffle0_1030000'}
+WORDS = ['the', 'cat', 'sat', 'on', 'a', 'mat', 'she', 'sells', 'sea', 'shells', 'by', 'shore', 'peter', 'piper',
+         'picked', 'peck', 'of', 'pickled', 'peppers', 'how', 'much', 'wood', 'would', 'chuck', 'if', 'could',
+         'red', 'lorry', 'yellow', 'unique', 'new', 'york', 'you', 'know', 'need', 'it', 'is', 'good', 'day']
+
+
+def speaker_name(index):
+    """ TaL speaker folders are numbered, with the gender as the third character """
+    return f'{index + 1:02d}{"fm"[index % 2]}i'
+
+
+def prompt(rng):
+    return ' '.join(rng.choice(WORDS, size=int(rng.integers(3, 9)))) + '\n'
+
+
+def write_param(base_path):
+    with open(base_path + '.param', 'w') as f:
+        for name, value in PARAMS.items():
+            f.write(f'{name}={value}\n')
+
+
+def write_ultrasound(base_path, seconds, rng):
+    """
+    Speckle noise with a bright contour whose depth moves along the scanlines over time.
+    As in TaL, the ultrasound starts last and finishes after the video and audio.
+    """
+    frames = int((seconds + ULTRASOUND_OVERRUN - PARAMS['TimeInSecsOfFirstFrame']) * PARAMS['FramesPerSec'])
+    scanlines, echos = PARAMS['NumVectors'], PARAMS['PixPerVector']
+    t = numpy.arange(frames).reshape(-1, 1, 1) / PARAMS['FramesPerSec']
+    lines = numpy.arange(scanlines).reshape(1, -1, 1)
+    depth = 420 + 120 * numpy.sin(numpy.pi * lines / scanlines) + 60 * numpy.sin(2 * numpy.pi * 1.5 * t + lines / 9)
+    echo = numpy.arange(echos).reshape(1, 1, -1)
+    contour = 180 * numpy.exp(-((echo - depth) / 12) ** 2)
+    speckle = rng.gamma(2.0, 15.0, size=(frames, scanlines, echos))
+    numpy.clip(contour + speckle, 0, 255).astype(numpy.uint8).tofile(base_path + '.ult')
+
+
+def write_waveform(base_path, seconds, rng):
+    t = numpy.arange(int(seconds * WAV_RATE)) / WAV_RATE
+    wav = 3000 * numpy.sin(2 * numpy.pi * 140 * t) * (1 + numpy.sin(2 * numpy.pi * 3 * t)) / 2
+    wav += rng.normal(0, 200, size=t.shape)
+    wavfile.write(base_path + '.wav', WAV_RATE, wav.astype(numpy.int16))
+
+
+def write_lip_video(base_path, seconds, rng):
+    """ A dark mouth opening and closing on a lighter face """
+    width, height = VIDEO_SIZE
+    y, x = numpy.mgrid[:height, :width]
+    writer = imageio_ffmpeg.write_frames(base_path + '.mp4', VIDEO_SIZE, pix_fmt_in='gray', fps=VIDEO_FPS,
+                                         macro_block_size=1, output_params=['-crf', '28'])
+    writer.send(None)
+    for frame in range(int(seconds * VIDEO_FPS) + 1):
+        opening = 10 + 25 * (1 + numpy.sin(2 * numpy.pi * 2 * frame / VIDEO_FPS)) / 2
+        mouth = ((x - width / 2) / 70) ** 2 + ((y - height / 2) / opening) ** 2 < 1
+        image = numpy.where(mouth, 40, 170) + rng.normal(0, 6, size=(height, width))
+        writer.send(numpy.clip(image, 0, 255).astype(numpy.uint8).tobytes())
+    writer.close()
+
+
+def dlc_frames(seconds):
+    """ The number of frames in the videos made for DLC, after trimming to the parallel streams """
+    start, end = PARAMS['TimeInSecsOfFirstFrame'], seconds
+    return int(numpy.floor(end * DLC_FPS)) - int(numpy.ceil(start * DLC_FPS))
+
+
+def synthetic_poses(anatomy, frames, rng):
+    """
+    DLC output for the anatomy: the x, y and likelihood of each part, which drift smoothly,
+    with a few unlikely frames and outliers for the filters.
+    """
+    t = numpy.arange(frames).reshape(-1, 1) / DLC_FPS
+    parts = len(anatomy)
+    centre = rng.uniform(50, 250, size=(1, parts, 2))
+    motion = 15 * numpy.sin(2 * numpy.pi * rng.uniform(0.5, 3, size=(1, parts, 1)) * t[:, :, None]
+                            + rng.uniform(0, 2 * numpy.pi, size=(1, parts, 2)))
+    xy = centre + motion + rng.normal(0, 0.5, size=(frames, parts, 2))
+    outliers = rng.random((frames, parts)) < 0.005
+    xy[outliers] += 200
+    likelihood = rng.beta(8, 1, size=(frames, parts, 1))
+    return numpy.concatenate([xy, likelihood], axis=2).reshape(frames, -1)
+
+
+def write_dlc_csv(csv_file, anatomy, frames, rng):
+    """ A DLC output CSV of synthetic poses, with its scorer taken from the file name """
+    scorer = 'DLC' + os.path.basename(csv_file)[:-len('.csv')].split('DLC', 1)[1]
+    PoseCache.write_csv(csv_file, scorer, anatomy, synthetic_poses(anatomy, frames, rng))
+
+
+class StubPoseEstimator:
+    """ Stands in for tools.DlcPoseEstimator, estimating synthetic poses for any frames """
+    def __init__(self, folder, seed=0):
+        """ @param folder: USVideo or LipVideo """
+        self.scorer = SCORERS[folder]
+        self.bodyparts = TONGUE_ANATOMY if folder == 'USVideo' else LIP_ANATOMY
+        self.rng = numpy.random.default_rng(seed)
+
+    def estimate(self, frames):
+        return synthetic_poses(self.bodyparts, frames.shape[0], self.rng).astype(numpy.float32)
+
+
+def make_corpus(output, utterances, speakers=4, seconds=2.0, media=None, seed=0):
+    """
+    Writes the synthetic corpus under output: core/<speaker>/<utt>.* like TaL80/core, and features/USVideo
+    and features/LipVideo with the DLC CSVs, and features/all_text.
+    @param utterances: total number of utterances, half of them silent
+    @param seconds: length of each recording
+    @param media: number of utterances which get .ult, .wav and .mp4 files, all of them if None
+    @return: the utterance ids
+    """
+    rng = numpy.random.default_rng(seed)
+    features = os.path.join(output, 'features')
+    for folder in SCORERS:
+        os.makedirs(os.path.join(features, folder), exist_ok=True)
+    media = utterances if media is None else media
+
+    ids = []
+    lines = []
+    pairs = (utterances + 1) // 2
+    for k in range(pairs):
+        speaker = speaker_name(k % speakers)
+        shared = prompt(rng) if k % 4 == 0 else None
+        for modality in ['aud', 'sil']:
+            if len(ids) == utterances:
+                break
+            folder = os.path.join(output, 'core', speaker)
+            os.makedirs(folder, exist_ok=True)
+            name = f'{k // speakers:03d}_{modality}'
+            utt_id = f'{speaker}-{name}'
+            base_path = os.path.join(folder, name)
+            text = shared or prompt(rng)
+            length = seconds * rng.uniform(0.8, 1.2)
+
+            with open(base_path + '.txt', 'w') as f:
+                f.write(text)
+            write_param(base_path)
+            if len(ids) < media:
+                write_ultrasound(base_path, length, rng)
+                write_waveform(base_path, length, rng)
+                write_lip_video(base_path, length, rng)
+            frames = dlc_frames(length)
+            write_dlc_csv(os.path.join(features, 'USVideo', utt_id + SCORERS['USVideo'] + '.csv'),
+                          TONGUE_ANATOMY, frames, rng)
+            write_dlc_csv(os.path.join(features, 'LipVideo', utt_id + SCORERS['LipVideo'] + '.csv'),
+                          LIP_ANATOMY, frames, rng)
+            ids.append(utt_id)
+            lines.append(f'{utt_id} {text}')
+
+    with open(os.path.join(features, 'all_text'), 'w') as f:
+        f.writelines(lines)
+    return ids
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('output')
+    parser.add_argument('--utterances', type=int, default=100)
+    parser.add_argument('--speakers', type=int, default=4)
+    parser.add_argument('--seconds', type=float, default=2.0)
+    parser.add_argument('--media', type=int, default=None, help='utterances with .ult, .wav and .mp4 (default all)')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    ids = make_corpus(args.output, args.utterances, args.speakers, args.seconds, args.media, args.seed)
+    print(f'Wrote {len(ids)} utterances to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+"""
+Compares frames/sec of the two ways VideoMaker renders frames for DLC:
+matplotlib JPEGs read back by FFMPEG, and raw frames piped straight into FFMPEG.
+Run from the repo root (conf.ini is read from the working directory):
+python -m benchmarks.video_render --frames 300
+"""
+
+import argparse
+import os
+import tempfile
+import time
+import numpy
+from tools.VideoMaker import VideoMaker
+
+
+def time_render(video_maker, frames, origin, output_video_file):
+    start = time.perf_counter()
+    video_maker.make_video(frames, origin, output_video_file)
+    return (frames.shape[0] - 1) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--frames', type=int, default=300)
+    args = parser.parse_args()
+
+    rng = numpy.random.default_rng(0)
+    streams = {'ultrasound': (rng.random((args.frames, 650, 515)) * 255, 'lower'),
+               'lip': (rng.random((args.frames, 240, 320)) * 765, 'upper')}
+
+    with tempfile.TemporaryDirectory() as out_dir:
+        video_maker = VideoMaker(out_dir, out_dir)
+        video_maker.temp_directory = os.path.join(out_dir, 'frames')
+        for name, (frames, origin) in streams.items():
+            results = {}
+            for render in ['images', 'pipe']:
+                video_maker.render = render
+                results[render] = time_render(video_maker, frames, origin,
+                                              os.path.join(out_dir, f'{name}_{render}.mp4'))
+            print(f"{name}: images {results['images']:.1f} fps, pipe {results['pipe']:.1f} fps, "
+                  f"speedup x{results['pipe'] / results['images']:.1f}")
+
+
+if __name__ == '__main__':
+    main()
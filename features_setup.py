@@ -0,0 +1,15 @@
+"""
+Makes the features and Kaldi files from DLC CSVs which already exist, e.g. the ones shared with the project.
+Nothing from DLC, torch or matplotlib is imported, so this runs in an environment with only
+requirements-features.txt installed.
+"""
+import argparse
+from tools.UtteranceController import UtteranceController, STAGES
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--only', choices=['features', 'kaldi'], help='run this stage only')
+    args = parser.parse_args()
+    tal_setup = UtteranceController(make_features=False)
+    tal_setup.forward(stage=STAGES.index('features'), only=args.only)
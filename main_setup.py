@@ -1,11 +1,25 @@
-from tools.UtteranceController import UtteranceController
+import argparse
+from tools.UtteranceController import UtteranceController, STAGES
 from tools.config_manager import config
 
 
+def stage_index(value):
+    """ A stage can be given by its number or its name """
+    if value in STAGES:
+        return STAGES.index(value)
+    return int(value)
+
+
 class MainSetup:
-    def __init__(self):
+    def __init__(self, stage=0, only=None):
         tal_setup = UtteranceController(config.getboolean('Run', 'make_features'))
-        tal_setup.forward()
+        tal_setup.forward(stage=stage, only=only)
 
 if __name__ == '__main__':
-    MainSetup()
+    parser = argparse.ArgumentParser(description='Prepares the TaL corpus for Kaldi. Stages already completed '
+                                                 'for an utterance are skipped, so an interrupted run can be resumed.')
+    parser.add_argument('--stage', type=stage_index, default=0,
+                        help=f'first stage to run, by number or name: {", ".join(STAGES)}')
+    parser.add_argument('--only', choices=STAGES, help='run this stage only')
+    args = parser.parse_args()
+    MainSetup(args.stage, args.only)
@@ -12,7 +12,7 @@ if [ $stage -le 0 ]; then
 # Removing previously created data (from last run.sh execution)
 rm -rf data/train_sp*
 rm -rf data/train/split*
-rm -rf exp data/train/spk2utt data/train/cmvn.scp data/local/lang data/lang data/lang_old data/local/dict_old data/local/tmp data/local/dict/lexiconp.txt mfcc
+rm -rf exp data/local/lang data/lang data/lang_old data/local/dict_old data/local/tmp data/local/dict/lexiconp.txt mfcc
 fi
 if [ $stage -le 1 ]; then
 echo
@@ -25,35 +25,24 @@ echo
 # text        [<uterranceID> <text_transcription>]
 # utt2spk     [<uterranceID> <speakerID>]
 # corpus.txt  [<text_transcription>]
-# Making spk2utt files
-utils/utt2spk_to_spk2utt.pl data/train/utt2spk > data/train/spk2utt
+# spk2utt, utt2num_frames and utt2dur are written, sorted and validated by main_setup.py,
+# so there is no need for utt2spk_to_spk2utt.pl, feat-to-len, fix_data_dir.sh or validate_data_dir.sh
 
     
 echo
 echo "===== FEATURES FORMATTING ====="
 echo
-# Making feats.scp files
+# feats.ark and feats.scp are written in Kaldi binary format by main_setup.py,
+# so there is no need to convert them with copy-feats
 mfccdir=mfcc
-
-#copy-feats ark:data/sil_test/feats.txt ark,scp:data/sil_test/feats.ark,data/sil_test/feats.scp
-#copy-feats ark:data/mod_test/feats.txt ark,scp:data/mod_test/feats.ark,data/mod_test/feats.scp
-copy-feats ark:data/train/feats.txt ark,scp:data/train/feats.ark,data/train/feats.scp
+mkdir -p $mfccdir
 
 cp data/train/feats.scp mfcc/raw_mfcc_train.1.scp
 cp data/train/feats.ark mfcc/raw_mfcc_train.1.ark
 
-#calculate utt2dur
-
-frame_shift=$(cat data/train/frame_shift)
-  feat-to-len scp:data/train/feats.scp ark,t:- |
-    awk -v frame_shift=$frame_shift '{print $1, ($2)*frame_shift}' >data/train/utt2dur
-
-utils/validate_data_dir.sh data/train --no-wav     # script for checking prepared data - here: for data/train directory
-utils/fix_data_dir.sh data/train          # tool for data proper sorting if needed - here: for data/train directory
-
 
-# Making cmvn.scp files
-steps/compute_cmvn_stats.sh data/train exp/make_mfcc/train $mfccdir
+# Making cmvn.scp files, unless main_setup.py wrote them with the features
+[ -f data/train/cmvn.scp ] || steps/compute_cmvn_stats.sh data/train exp/make_mfcc/train $mfccdir
 echo
 echo "===== PREPARING LANGUAGE DATA ====="
 echo
@@ -4,21 +4,18 @@
 
 fmllr=0
 dir=exp/nnet5c
+mfccdir=mfcc
 
 for test in sil_test mod_test; do
 
 cp data/$test/feats.scp mfcc/raw_mfcc_test.1.scp
 cp data/$test/feats.ark mfcc/raw_mfcc_test.1.ark
 
-utils/utt2spk_to_spk2utt.pl data/$test/utt2spk > data/$test/spk2utt
+# spk2utt, utt2num_frames and utt2dur are written, sorted and validated by main_setup.py,
+# so there is no need for utt2spk_to_spk2utt.pl, fix_data_dir.sh or validate_data_dir.sh
 
-utils/validate_data_dir.sh data/$test --no-wav    # script for checking prepared data
-
-utils/fix_data_dir.sh data/$test 
-
-# Making cmvn.scp files
-
-steps/compute_cmvn_stats.sh data/$test exp/make_mfcc/$test $mfccdir
+# Making cmvn.scp files, unless main_setup.py wrote them with the features
+[ -f data/$test/cmvn.scp ] || steps/compute_cmvn_stats.sh data/$test exp/make_mfcc/$test $mfccdir
 
 utils/mkgraph.sh data/lang exp/tri3b exp/tri3b/graph || exit 1
 
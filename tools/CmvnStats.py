@@ -0,0 +1,55 @@
+import numpy
+from tools.kaldi_io import KaldiArkWriter
+
+
+class CmvnStats:
+    """
+    CMVN statistics of each speaker (or utterance), gathered in the same pass as the features are written,
+    so Kaldi does not need to read the archives again with compute-cmvn-stats. The frame count, mean and sum
+    of squared deviations of each key are updated a whole utterance at a time, with Chan et al.'s pairwise
+    form of Welford's algorithm, which does not lose precision as the sums of squares of long speakers grow.
+    They are written as the count, sums and sums of squares Kaldi's cmvn.ark holds.
+    """
+    def __init__(self):
+        self.counts = {}
+        self.means = {}
+        self.deviations = {}
+
+    def add(self, key, matrix):
+        """
+        Adds an utterance's features to the statistics of a key.
+        @param matrix: (frames, dims) features, as they are written to the ark
+        """
+        matrix = numpy.asarray(matrix, dtype=numpy.float32).astype(numpy.float64)
+        frames = matrix.shape[0]
+        if not frames:
+            return
+        mean = matrix.mean(axis=0)
+        deviations = numpy.square(matrix - mean).sum(axis=0)
+        if key not in self.counts:
+            self.counts[key], self.means[key], self.deviations[key] = frames, mean, deviations
+            return
+        count = self.counts[key]
+        total = count + frames
+        delta = mean - self.means[key]
+        self.means[key] = self.means[key] + delta * frames / total
+        self.deviations[key] = self.deviations[key] + deviations + numpy.square(delta) * count * frames / total
+        self.counts[key] = total
+
+    def kaldi_stats(self, key):
+        """
+        The statistics of a key as Kaldi holds them: a (2, dims + 1) matrix of the sums of the features and
+        the frame count in the first row, and the sums of their squares in the second.
+        """
+        count, mean = self.counts[key], self.means[key]
+        stats = numpy.zeros((2, mean.shape[0] + 1), dtype=numpy.float64)
+        stats[0, :-1] = count * mean
+        stats[0, -1] = count
+        stats[1, :-1] = self.deviations[key] + count * numpy.square(mean)
+        return stats
+
+    def write(self, ark_path, scp_path):
+        """ Writes cmvn.ark and its cmvn.scp, with the statistics of each key as a binary double matrix """
+        with KaldiArkWriter(ark_path, scp_path) as writer:
+            for key in sorted(self.counts):
+                writer.write(key, self.kaldi_stats(key), double=True)
@@ -0,0 +1,137 @@
+import os
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+MANIFEST_HEADER = '# TaL corpus manifest'
+
+
+def modality_of(utt_name):
+    """ Silent utterances have sil in their name and modal ones aud, anything else is not used """
+    if 'sil' in utt_name:
+        return 'silent'
+    if 'aud' in utt_name:
+        return 'modal'
+    return None
+
+
+def read_text(base_path):
+    """ The prompt of an utterance is the first line of its .txt file """
+    with open(base_path + '.txt', 'r') as f:
+        return f.readline().rstrip('\n') + '\n'
+
+
+class CorpusIndexer:
+    """
+    Indexes the utterances of the TaL corpus into a manifest file, which later runs load instead of walking
+    the corpus again. Each speaker folder is listed once with os.scandir, and the .txt files are read on
+    a thread pool, since on a network mount the time goes on waiting for the file system rather than CPU.
+    A refresh only reads the text of utterances which are new or whose .txt has a different size or mtime.
+
+    The manifest has a header line, then one utterance per line:
+    id, modality, base_path, the size and mtime of each of its files as json, and the text, separated by tabs.
+    make_utts reads it when tal_path points to it, as well as the plain "utt_id text" files.
+    """
+    def __init__(self, tal_path, manifest_path, workers=16):
+        self.tal_path = tal_path
+        self.manifest_path = manifest_path
+        self.workers = workers
+
+    def index(self):
+        """
+        Brings the manifest up to date with the corpus, rewriting it only if something changed.
+        @return: list of utterance records (dicts of id, modality, text, base_path and files), sorted by id
+        """
+        known = {}
+        if os.path.isfile(self.manifest_path):
+            if self.header() == self.read_header(self.manifest_path):
+                known = {record['id']: record for record in self.load(self.manifest_path)}
+
+        with ThreadPoolExecutor(self.workers) as pool:
+            found = [record for folder in pool.map(self.scan_folder, self.speaker_folders()) for record in folder]
+            stale = [record for record in found if self.needs_text(record, known.get(record['id']))]
+            for record, text in zip(stale, pool.map(read_text, [record['base_path'] for record in stale])):
+                record['text'] = text
+        for record in found:
+            if 'text' not in record:
+                record['text'] = known[record['id']]['text']
+        found.sort(key=lambda record: record['id'])
+
+        if stale or len(found) != len(known) or any(record['files'] != known[record['id']]['files']
+                                                    for record in found):
+            print(f'Indexed {len(found)} utterances in {self.tal_path}, read {len(stale)} texts')
+            self.write(found)
+        return found
+
+    def speaker_folders(self):
+        with os.scandir(self.tal_path) as entries:
+            return sorted(entry.path for entry in entries if entry.is_dir())
+
+    @staticmethod
+    def scan_folder(folder):
+        """
+        Lists one speaker folder and groups its files by utterance.
+        There should be one param file for every utterance.
+        @return: list of records without their text
+        """
+        speaker = os.path.basename(folder)
+        files = {}
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                utt_id, _, ext = entry.name.partition('.')
+                if ext and entry.is_file():
+                    stat = entry.stat()
+                    files.setdefault(utt_id, {})[ext] = [stat.st_size, stat.st_mtime_ns]
+        records = []
+        for utt_id, utt_files in files.items():
+            utt_name = speaker + '-' + utt_id
+            modality = modality_of(utt_name)
+            if 'param' in utt_files and modality is not None:
+                records.append({'id': utt_name, 'modality': modality, 'base_path': os.path.join(folder, utt_id),
+                                'files': utt_files})
+        return records
+
+    @staticmethod
+    def needs_text(record, known):
+        return known is None or known['files'].get('txt') != record['files'].get('txt')
+
+    def header(self):
+        return f'{MANIFEST_HEADER} of {os.path.abspath(self.tal_path)}'
+
+    @staticmethod
+    def read_header(path):
+        with open(path, 'r') as f:
+            return f.readline().rstrip('\n')
+
+    def write(self, records):
+        """ Writes the manifest to a temporary file first, so an interrupted write leaves the old one intact """
+        os.makedirs(os.path.dirname(self.manifest_path) or '.', exist_ok=True)
+        temp_path = self.manifest_path + '.tmp'
+        with open(temp_path, 'w') as f:
+            f.write(self.header() + '\n')
+            for record in records:
+                f.write('\t'.join([record['id'], record['modality'], record['base_path'],
+                                   json.dumps(record['files'], sort_keys=True), record['text']]))
+        os.replace(temp_path, self.manifest_path)
+
+    @staticmethod
+    def load(path):
+        """
+        Reads utterance records from a manifest, or from a file of "utt_id text" lines.
+        Utterances from the latter have no base_path, so no videos can be made from them.
+        """
+        records = []
+        with open(path, 'r') as f:
+            lines = f.readlines()
+        if lines and lines[0].startswith(MANIFEST_HEADER):
+            for line in lines[1:]:
+                [utt_id, modality, base_path, files, text] = line.split('\t', 4)
+                records.append({'id': utt_id, 'modality': modality, 'base_path': base_path,
+                                'files': json.loads(files), 'text': text})
+        else:
+            for line in lines:
+                [utt_id, text] = line.split(' ', 1)
+                modality = modality_of(utt_id)
+                if modality is not None:
+                    records.append({'id': utt_id, 'modality': modality, 'base_path': None, 'files': {},
+                                    'text': text})
+        return records
@@ -0,0 +1,59 @@
+import os
+import numpy
+
+
+class DlcPoseEstimator:
+    """
+    Runs a DLC model on frames held in memory, through the same TensorFlow inference analyze_videos runs
+    on each batch of frames it decodes from a video, so the frames need not be encoded to and decoded from
+    MP4 in between. The model is loaded once, from the snapshot and shuffle analyze_videos would use.
+    A pose estimator only needs scorer, bodyparts and estimate, so a stub can stand in for it on CPU.
+    """
+    def __init__(self, dlc_project, shuffle, batch_size=32):
+        """
+        @param dlc_project: the DLC project folder, with its config.yaml
+        @param batch_size: frames given to the model at a time
+        """
+        from deeplabcut.utils import auxiliaryfunctions
+        from deeplabcut.pose_estimation_tensorflow.config import load_config
+        from deeplabcut.pose_estimation_tensorflow.core import predict
+
+        cfg = auxiliaryfunctions.read_config(os.path.join(dlc_project, 'config.yaml'))
+        train_fraction = cfg['TrainingFraction'][0]
+        model_folder = os.path.join(cfg['project_path'],
+                                    str(auxiliaryfunctions.get_model_folder(train_fraction, shuffle, cfg)))
+        self.dlc_cfg = load_config(os.path.join(model_folder, 'test', 'pose_cfg.yaml'))
+        snapshots = sorted((name[:-len('.index')] for name in os.listdir(os.path.join(model_folder, 'train'))
+                            if name.endswith('.index')), key=lambda name: int(name.split('-')[1]))
+        snapshot_index = cfg['snapshotindex']
+        if snapshot_index == 'all':
+            # analyze_videos does the same, as analysing with every snapshot is of little use
+            print("snapshotindex is 'all' in the config.yaml, so the last snapshot is used")
+            snapshot_index = -1
+        if not isinstance(snapshot_index, int) or not -len(snapshots) <= snapshot_index < len(snapshots):
+            raise ValueError(f'snapshotindex {snapshot_index!r} in {dlc_project} does not pick one of the '
+                             f'{len(snapshots)} snapshots in {os.path.join(model_folder, "train")}')
+        snapshot = snapshots[snapshot_index]
+        self.dlc_cfg['init_weights'] = os.path.join(model_folder, 'train', snapshot)
+        self.dlc_cfg['batch_size'] = batch_size
+        self.scorer, _ = auxiliaryfunctions.GetScorerName(cfg, shuffle, train_fraction,
+                                                          trainingsiterations=snapshot.split('-')[1])
+        self.bodyparts = list(self.dlc_cfg['all_joints_names'])
+        self.batch_size = batch_size
+        self.predict = predict
+        self.session, self.inputs, self.outputs = predict.setup_pose_prediction(self.dlc_cfg)
+
+    def estimate(self, frames):
+        """
+        @param frames: (frames, height, width) uint8 grayscale frames
+        @return: (frames, 3 * body parts) float32 array of x, y and likelihood of each part, as DLC saves them
+        """
+        poses = numpy.empty((frames.shape[0], 3 * len(self.bodyparts)), dtype=numpy.float32)
+        # the model takes full batches of RGB frames, as DLC decodes them from the video
+        batch = numpy.zeros((self.batch_size,) + frames.shape[1:] + (3,), dtype=numpy.uint8)
+        for start in range(0, frames.shape[0], self.batch_size):
+            chunk = frames[start:start + self.batch_size]
+            batch[:chunk.shape[0]] = chunk[..., None]
+            pose = self.predict.getposeNP(batch, self.dlc_cfg, self.session, self.inputs, self.outputs)
+            poses[start:start + chunk.shape[0]] = pose[:chunk.shape[0]]
+        return poses
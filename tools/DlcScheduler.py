@@ -0,0 +1,96 @@
+import queue
+import threading
+import traceback
+from tools.run_report import report
+
+_FINISHED = object()
+
+
+class DlcScheduler:
+    """
+    Runs DLC on the videos of each utterance as soon as they are made, instead of once the whole corpus
+    has been rendered. Rendering submits each finished utterance's videos, and a consumer thread hands
+    them to the analyzer in batches of batch_size, lips first and then ultrasound as run_DLC does, so
+    inference runs while the next videos are rendered. The queue holds at most queue_size utterances:
+    if DLC falls behind, rendering waits for it rather than filling the disk with videos.
+    The analyzer has the signature of deeplabcut.analyze_videos, so a stub can stand in for DLC on CPU.
+    With pose estimators, the utterances' frames are queued instead of their videos, and each batch of
+    frames goes straight to the estimators, without videos being written or read. The estimators are
+    loaded by the consumer thread, so the models load while the first frames are made.
+    """
+    def __init__(self, feature_makers, batch_size=64, queue_size=256, analyzer=None, load_estimators=None):
+        """
+        @param feature_makers: the (US, lip) feature makers, whose videos are analysed with their DLC project
+        @param analyzer: called as analyzer(dlc_config, videos, shuffle=..., save_as_csv=True), DLC if None
+        @param load_estimators: returns the (US, lip) pose estimators for the frames, e.g. DlcPoseEstimators
+        """
+        self.feature_makers = feature_makers
+        self.batch_size = batch_size
+        self.queue = queue.Queue(queue_size)
+        self.analyzer = analyzer
+        self.load_estimators = load_estimators
+        self.estimators = None
+        self.analyzed = []
+        self.error = None
+        self.cancelled = False
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.consume, name='dlc-scheduler', daemon=True)
+        self.thread.start()
+        return self
+
+    def submit(self, utterance, videos):
+        """
+        Queues an utterance's videos for DLC, waiting while the queue is full.
+        @param videos: the (US, lip) video paths, in the order of the feature makers, or their frames
+                       if the scheduler has pose estimators
+        """
+        if self.error is not None:
+            raise RuntimeError(f'DLC failed, no more videos can be analysed:\n{self.error}')
+        self.queue.put((utterance, videos))
+
+    def finish(self, cancel=False):
+        """
+        Analyses what is left in the queue and stops the consumer.
+        @param cancel: drop what is left in the queue instead, e.g. once rendering has failed
+        @return: the utterances whose videos were analysed
+        """
+        self.cancelled = cancel
+        self.queue.put(_FINISHED)
+        self.thread.join()
+        if self.error is not None:
+            raise RuntimeError(f'DLC failed:\n{self.error}')
+        return self.analyzed
+
+    def consume(self):
+        """ Takes batches off the queue until finish is called. After a failure or a cancel, it is only drained. """
+        finished = False
+        while not finished:
+            batch = []
+            while len(batch) < self.batch_size:
+                item = self.queue.get()
+                if item is _FINISHED:
+                    finished = True
+                    break
+                batch.append(item)
+            if batch and self.error is None and not self.cancelled:
+                try:
+                    self.analyze(batch)
+                except Exception:
+                    self.error = traceback.format_exc()
+
+    def analyze(self, batch):
+        US_feature_maker, lip_feature_maker = self.feature_makers
+        with report.step('dlc') as record:
+            for feature_maker, index in [(lip_feature_maker, 1), (US_feature_maker, 0)]:
+                inputs = [videos[index] for _, videos in batch]
+                if self.load_estimators is None:
+                    feature_maker.run_DLC(inputs, self.analyzer)
+                else:
+                    if self.estimators is None:
+                        self.estimators = self.load_estimators()
+                    feature_maker.estimate_poses([utterance.id for utterance, _ in batch], inputs,
+                                                 self.estimators[index])
+                    record['frames'] += sum(len(frames) for frames in inputs)
+        self.analyzed.extend(utterance for utterance, _ in batch)
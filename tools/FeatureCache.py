@@ -0,0 +1,85 @@
+import os
+import json
+import hashlib
+import inspect
+import numpy
+
+
+def code_version(*objects):
+    """ Hash of the source files of the modules or classes which decide what the features look like """
+    digest = hashlib.sha1()
+    for obj in objects:
+        with open(inspect.getfile(obj), 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+class FeatureCache:
+    """
+    Content-addressed cache of each utterance's combined, normalised features.
+    The key combines everything the features depend on: the fingerprint (name, mtime and size) of the
+    pose files, the filter settings and the version of the feature code. So changing one option only
+    recomputes the features it affects, and changing nothing recomputes nothing.
+    Entries are .npy files; the least recently used ones are evicted once the cache outgrows max_bytes.
+    """
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(*parts):
+        """ Builds a key from json-serialisable parts """
+        return hashlib.sha1(json.dumps(parts, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + '.npy')
+
+    def contains(self, key):
+        """ Whether there is an entry for the key; a key without one is counted as a miss, and need not be read """
+        if os.path.isfile(self.path(key)):
+            return True
+        self.misses += 1
+        return False
+
+    def get(self, key):
+        """
+        @return: the cached features, or None on a miss. Discarded utterances are cached as an empty array.
+        """
+        path = self.path(key)
+        try:
+            features = numpy.load(path)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        os.utime(path)  # marks the entry as recently used
+        self.hits += 1
+        return features
+
+    def put(self, key, features):
+        """ Stores features, or an empty array for a discarded utterance """
+        if features is None:
+            features = numpy.empty((0, 0))
+        # the folder is only made once there is something to cache, not for runs which never extract features
+        os.makedirs(self.cache_dir, exist_ok=True)
+        temp_path = self.path(key) + '.tmp.npy'
+        numpy.save(temp_path, features)
+        os.replace(temp_path, self.path(key))
+
+    def evict(self):
+        """ Removes the least recently used entries until the cache fits in max_bytes """
+        if not os.path.isdir(self.cache_dir):
+            return
+        with os.scandir(self.cache_dir) as entries:
+            files = [(entry.stat().st_mtime, entry.stat().st_size, entry.path) for entry in entries
+                     if entry.name.endswith('.npy')]
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            os.remove(path)
+            total -= size
+
+    def report(self):
+        return f'Feature cache: {self.hits} hits, {self.misses} misses'
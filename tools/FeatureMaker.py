@@ -1,10 +1,8 @@
 import os
-import glob
-import deeplabcut
 import pandas
 import numpy
-import scipy.signal as sig
-import statistics
+from tools import pose_filters
+from tools.PoseCache import PoseCache
 from tools.config_manager import config
 
 
@@ -29,82 +27,141 @@ class FeatureMaker:
         self.dlc_project = dlc_project
         self.video_folder = video_folder
         self.features = pandas.DataFrame()
+        self.csv_index = None
+        self.use_pose_cache = config.getboolean('PostDLC', 'pose_cache', fallback=True)
+        self.pose_cache = None
+        self.bytes_read = 0  # by the last process_features, for the run report
 
-    def run_DLC(self):
-        """ Runs DLC either for Lips or US depending on object instantiation """
+    def run_DLC(self, videos=None, analyzer=None):
+        """
+        Runs DLC either for Lips or US depending on object instantiation.
+        DLC is only imported here, so the features can be made from existing CSVs without it installed.
+        @param videos: paths of the videos to analyse, the whole video folder if None
+        @param analyzer: stands in for deeplabcut.analyze_videos, e.g. a stub to run on CPU
+        """
+        if analyzer is None:
+            import deeplabcut
+            analyzer = deeplabcut.analyze_videos
         dlc_config = os.path.join(self.dlc_project, 'config.yaml')
-        deeplabcut.analyze_videos(dlc_config, self.video_folder, shuffle=self.dlc_shuffle, save_as_csv=True)
+        analyzer(dlc_config, self.video_folder if videos is None else videos, shuffle=self.dlc_shuffle,
+                 save_as_csv=True)
 
-    def process_features(self, utterance):
-        """ Grabs CSV file output by DLC for a particular utterance and creates features """
-        if utterance.base_path is None:
-            format_utt = utterance.id.replace('-', '_', 1)
-        else:
-            format_utt = utterance.id
-        if glob.glob(os.path.join(self.video_folder, f'{format_utt}*.csv')):
-            csv_file = glob.glob(os.path.join(self.video_folder, f'{format_utt}*.csv'))[0]
-            self.features = pandas.read_csv(csv_file,
-                                        header=[1, 2])  # headers are two parts, anatomy and then x, y or likelihood
-            self.feature_maker()
+    def estimate_poses(self, utt_ids, frames, estimator):
+        """
+        Estimates the poses in utterances' frames, held in memory rather than in videos, and saves them
+        where and how DLC would have, so they are indexed, cached and processed like the output of run_DLC.
+        The frames of all the utterances go to the estimator together, so its batches are full.
+        @param frames: each utterance's frames as they would be in its video, see VideoMaker.layout_frames
+        @param estimator: e.g. a DlcPoseEstimator with this folder's DLC project
+        """
+        poses = estimator.estimate(numpy.concatenate(frames) if len(frames) > 1 else frames[0])
+        ends = numpy.cumsum([len(utt_frames) for utt_frames in frames])
+        for utt_id, utt_poses in zip(utt_ids, numpy.split(poses, ends[:-1])):
+            csv_file = os.path.join(self.video_folder, utt_id + estimator.scorer + '.csv')
+            PoseCache.write_csv(csv_file, estimator.scorer, estimator.bodyparts, utt_poses)
+
+    def index_csvs(self, utterances=()):
+        """
+        Scans the video folder once and maps each utterance id to the CSV DLC produced for it.
+        DLC names its output <video name><scorer name>.csv, and the CSVs made for the all_text file
+        are named speaker_utt rather than speaker-utt, so every CSV is indexed under the speaker-utt form.
+        If an utterance has several CSVs, the one from the configured shuffle is preferred.
+        Utterances with no CSV, or with several, are reported before any features are processed.
+        @param utterances: utterance objects to check against the index
+        """
+        candidates = {}
+        with os.scandir(self.video_folder) as entries:
+            for entry in entries:
+                if not entry.is_file() or not entry.name.endswith('.csv'):
+                    continue
+                utt_id = entry.name[:-len('.csv')].split('DLC', 1)[0]
+                if '-' not in utt_id:
+                    utt_id = utt_id.replace('_', '-', 1)
+                candidates.setdefault(utt_id, []).append(entry.path)
 
-    def feature_maker(self):
-        """ Driver for feature manipulation. """
-        if self.likelihood_filter:
-            self.likelihood_filtering()
-        if self.outlier_filter:
-            self.outlier_filtering()
-        if self.lowpass_filter:
-            self.low_pass_filtering()
-        self.features.drop([(part, 'likelihood') for part in self.anatomy], axis=1, inplace=True)
-        if self.features.isnull().values.any():
-            self.features = pandas.DataFrame()
-        self.features = self.features.to_numpy()
+        self.csv_index = {}
+        duplicates = []
+        for utt_id, csv_files in candidates.items():
+            csv_files.sort(key=lambda path: (f'shuffle{self.dlc_shuffle}' not in os.path.basename(path), path))
+            self.csv_index[utt_id] = csv_files[0]
+            if len(csv_files) > 1:
+                duplicates.append(utt_id)
 
-    def likelihood_filtering(self):
+        missing = [utt.id for utt in utterances if utt.id not in self.csv_index]
+        if missing:
+            print(f'No DLC CSV in {self.video_folder} for {len(missing)} utterances, they will be discarded: '
+                  f'{" ".join(missing)}')
+        if duplicates:
+            print(f'Several DLC CSVs in {self.video_folder} for {len(duplicates)} utterances, '
+                  f'preferring shuffle{self.dlc_shuffle}: {" ".join(duplicates)}')
+
+    def load_pose_cache(self, update=True):
+        """
+        Brings the binary cache of this folder's DLC output up to date, so that features are read
+        from a memory-mapped array rather than by parsing every CSV again.
+        @param update: False to only open the cache as it is, e.g. in worker processes once the
+                       main process has updated it
         """
-         Takes the features and replaces values which have an associated likelihood of < .1 with NaN.
-         Likelihood is a value output from DLC and represents confidence about a prediction.
-         The NaNs are interpolated over.
-         """
-        for part in self.anatomy:
-            self.features[(part, 'x')].where(self.features[(part, 'likelihood')] > self.likelihood_cutoff,
-                                             other = numpy.nan, inplace=True)
-            self.features[(part, 'y')].where(self.features[(part, 'likelihood')] > self.likelihood_cutoff,
-                                             other = numpy.nan, inplace=True)
-        self.features.interpolate(axis=0, limit_direction='both', inplace=True)
+        if self.csv_index is None:
+            self.index_csvs()
+        self.pose_cache = PoseCache(self.video_folder)
+        if update:
+            self.pose_cache.update(self.csv_index)
+        else:
+            self.pose_cache.load()
+
+    def fingerprint(self, utterance):
+        """ Name, mtime and size of the DLC output for an utterance, or None if there is none """
+        if self.csv_index is None:
+            self.index_csvs()
+        csv_file = self.csv_index.get(utterance.id)
+        if csv_file is None:
+            return None
+        stat = os.stat(csv_file)
+        return [os.path.basename(csv_file), stat.st_mtime_ns, stat.st_size]
+
+    def settings(self):
+        """ The options which decide what the features look like """
+        return {'anatomy': self.anatomy,
+                'likelihood': self.likelihood_cutoff if self.likelihood_filter else None,
+                'outlier': self.outlier_cutoff if self.outlier_filter else None,
+                'lowpass': self.lowpass_cutoff if self.lowpass_filter else None,
+                'pose_cache': self.use_pose_cache}
 
-    def outlier_filtering(self):
-        """ Interpolates over values which are > 3 * sd away from the mean."""
-        for part in self.anatomy:
-            std_x = statistics.stdev(self.features[(part, 'x')])
-            mean_x = statistics.mean(self.features[(part, 'x')])
-            std_y = statistics.stdev(self.features[(part, 'y')])
-            mean_y = statistics.mean(self.features[(part, 'y')])
-            self.features[(part, 'x')].where((self.features[(part, 'x')] < mean_x + (std_x * self.outlier_cutoff)) &
-                                             (self.features[(part, 'x')] > mean_x - (std_x * self.outlier_cutoff)),
-                                             other = numpy.nan, inplace = True)
-            self.features[(part, 'y')].where((self.features[(part, 'y')] < mean_y + (std_y * self.outlier_cutoff)) &
-                                             (self.features[(part, 'y')] > mean_y - (std_y * self.outlier_cutoff)),
-                                             other=numpy.nan, inplace=True)
-        self.features.interpolate(axis=0, limit_direction='both', inplace=True)
+    def process_features(self, utterance):
+        """
+        Looks up the output DLC produced for a particular utterance and creates features.
+        The output is read from the pose cache if enabled, otherwise from the CSV itself.
+        If there is no output, the features are left empty so the utterance is discarded.
+        """
+        if self.csv_index is None:
+            self.index_csvs()
+        if self.use_pose_cache and self.pose_cache is None:
+            self.load_pose_cache()
+        csv_file = self.csv_index.get(utterance.id)
+        if csv_file is None:
+            self.features = []
+            self.bytes_read = 0
+            return
+        poses = self.pose_cache.get(utterance.id) if self.pose_cache is not None else None
+        if poses is not None:
+            self.bytes_read = poses.nbytes
+            self.feature_maker(poses, self.pose_cache.columns)
+        else:
+            self.bytes_read = os.path.getsize(csv_file)
+            table = pandas.read_csv(csv_file, header=[1, 2])  # headers are two parts, anatomy and then x, y or likelihood
+            self.feature_maker(table.to_numpy(dtype=numpy.float64), list(table.columns))
 
-    def low_pass_filtering(self):
+    def feature_maker(self, poses, columns):
         """
-        Low pass filters the features using a 3rd order butterworth filter with a chosen threshold.
-        Articulators have been observed to not exceed 9 syll per second.
-        (See Knuijt et al. "Reference values of maximum performance tests of speech production")
-        Any other "jitter" then could be considered noise introduced from processing.
+        Driver for feature manipulation. The DLC output is filtered as one array by tools.pose_filters:
+        likelihoods not above the cutoff and values more than outlier_cutoff SDs from the mean are
+        interpolated over, and the trajectories are low-pass filtered.
+        @param poses: (frames, columns) array of DLC output
+        @param columns: (body part, coordinate) label of each column
         """
-        sos = sig.butter(3, self.lowpass_cutoff, output='sos', fs=60)
-        for part in self.anatomy:
-            prefix_x = self.features[(part, 'x')][(self.features.index < 15)]
-            prefix_y = self.features[(part, 'y')][(self.features.index < 15)]
-            # sosfilt results in initial wave artefact
-            # we prefix the trajectory with the first 15 frames duplicated
-            # and then cut them off after
-            total_x = pandas.concat([prefix_x, (self.features[(part, 'x')])], axis = 0)
-            total_y = pandas.concat([prefix_y, (self.features[(part, 'y')])], axis = 0)
-            filtered_x = sig.sosfilt(sos, total_x)
-            filtered_y = sig.sosfilt(sos, total_y)
-            self.features[(part, 'x')] = filtered_x[15:]
-            self.features[(part, 'y')] = filtered_y[15:]
\ No newline at end of file
+        self.features = pose_filters.filter_poses(
+            poses, columns, self.anatomy,
+            likelihood_cutoff=self.likelihood_cutoff if self.likelihood_filter else None,
+            outlier_cutoff=self.outlier_cutoff if self.outlier_filter else None,
+            lowpass_cutoff=self.lowpass_cutoff if self.lowpass_filter else None)
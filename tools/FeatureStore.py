@@ -0,0 +1,69 @@
+import numpy
+
+
+class FeatureStore:
+    """
+    Holds the combined features of every utterance in one contiguous float32 buffer, with the offset
+    and length of each utterance in index arrays, instead of one float64 array per utterance object.
+    The buffer grows by half again each time it fills, so appending is amortised O(1), and trim releases
+    the spare capacity once every utterance is in. Features are written to Kaldi as float32, so nothing
+    is lost by storing them that way.
+    """
+    def __init__(self, dims=None, initial_frames=4096):
+        self.dims = dims
+        self.frames = 0
+        self.count = 0
+        self.buffer = None
+        self.offsets = numpy.zeros(64, dtype=numpy.int64)
+        self.lengths = numpy.zeros(64, dtype=numpy.int64)
+        self.initial_frames = initial_frames
+
+    def append(self, matrix):
+        """
+        Copies one utterance's (frames, dims) features to the end of the buffer.
+        @return: the index of the utterance's features in the store
+        """
+        matrix = numpy.asarray(matrix)
+        if matrix.ndim != 2:
+            raise ValueError(f'Expected features of shape (frames, dims), got {matrix.shape}')
+        if self.dims is None:
+            self.dims = matrix.shape[1]
+        if matrix.shape[1] != self.dims:
+            raise ValueError(f'Expected features of shape (frames, {self.dims}), got {matrix.shape}')
+        self.reserve(self.frames + matrix.shape[0])
+        if self.count == len(self.offsets):
+            self.offsets = numpy.resize(self.offsets, 2 * self.count)
+            self.lengths = numpy.resize(self.lengths, 2 * self.count)
+
+        self.buffer[self.frames:self.frames + matrix.shape[0]] = matrix
+        self.offsets[self.count] = self.frames
+        self.lengths[self.count] = matrix.shape[0]
+        self.frames += matrix.shape[0]
+        self.count += 1
+        return self.count - 1
+
+    def reserve(self, frames):
+        """ Grows the buffer so it holds at least this many frames """
+        if self.buffer is not None and frames <= self.buffer.shape[0]:
+            return
+        capacity = max(frames, self.initial_frames, 3 * (0 if self.buffer is None else self.buffer.shape[0]) // 2)
+        self.resize(capacity)
+
+    def resize(self, capacity):
+        buffer = numpy.empty((capacity, self.dims), dtype=numpy.float32)
+        if self.buffer is not None:
+            buffer[:self.frames] = self.buffer[:self.frames]
+        self.buffer = buffer
+
+    def trim(self):
+        """ Shrinks the buffer to the frames it holds """
+        if self.buffer is not None and self.buffer.shape[0] > self.frames:
+            self.resize(self.frames)
+
+    def get(self, index):
+        """ A view of one utterance's features. Views taken before the buffer grows keep the old buffer alive. """
+        start = self.offsets[index]
+        return self.buffer[start:start + self.lengths[index]]
+
+    def nbytes(self):
+        return 0 if self.buffer is None else self.buffer.nbytes
@@ -1,7 +1,23 @@
 import os
 import re
-import nltk
+import json
+import collections
+import numpy
 from tools.config_manager import config
+from tools.kaldi_io import KaldiArkWriter
+from tools.CmvnStats import CmvnStats
+from tools.run_report import report
+
+# punctuation removed from the text files, and from the corpus before it is split into words
+TEXT_STRIP = re.compile(r'[^\w|\s|\']')
+LEXICON_STRIP = re.compile(r'[^\w|\s|\-|\:|\'|\;|]')
+STRESS = re.compile(r'[\d]')
+
+
+def sort_by_key(lines):
+    """ Sorts lines by their first field as Kaldi does, i.e. by bytes, as sort does with LC_ALL=C """
+    return sorted(lines, key=lambda line: line.split(' ', 1)[0].encode('utf-8'))
+
 
 class KaldiFileMaker:
     """
@@ -18,11 +34,15 @@ class KaldiFileMaker:
         self.wav = []  # not making wav.scp for this experiment but here if needed in future
         self.text = []
         self.u2s = []
-        self.feats = []
+        self.num_frames = []
+        self.feats = None
         self.frame_shift = 1 / config.getint('PreDLC', 'fps')
+        self.cmvn = config.getboolean('PostDLC', 'cmvn', fallback=True)
+        self.cmvn_per_utterance = config.getboolean('PostDLC', 'cmvn_per_utterance', fallback=False)
         self.data_dir = "data"
         self.local_dir = os.path.join("data", "local")
         self.dict_dir = os.path.join(self.local_dir, "dict")
+        self.dict_cache = os.path.join(self.local_dir, "pronunciation_cache")
         # Non-silence phones covers all possible phones in CMUdict or BEEP dict
         # This would need to be changed if using a different lexicon with different phones
         self.non_silence_phones = ['aa', 'ae', 'ah', 'ao', 'aw', 'ax', 'ay', 'b', 'ch', 'd',
@@ -55,43 +75,91 @@ class KaldiFileMaker:
     def lexicon_maker(self):
         """
         Builds the lexicon which contains the phone sequence corresponding to the words in the corpus.
+        Each word of the corpus vocabulary is looked up once, and words which are not in the dictionary
+        are written to oov.txt with their number of occurrences, e.g. to add lexicon entries by hand.
         """
-        self.get_pronunciation_dict()
-        self.lexicon = ['!SIL sil\n', '<UNK> spn\n']
-        not_in = []
+        vocabulary = collections.Counter()
         for phrase in self.corpus:
-            phrase = re.sub(r'[^\w|\s|\-|\:|\'|\;|]', '', phrase)
-            phrase = phrase.strip('\n')
-            phrase = phrase.split(' ')
-            for word in phrase:
-                if self.beep:
-                    word = word.upper()
-                else:
-                    word = word.lower()
-                try:
-                    list_word_phone_seq = self.dict[word]
-                except KeyError:
-                    print(f'The word {word} is not in the dictionary.')
-                    print(f'Ignoring {word}...')
-                    not_in.append(word)  # can use this to manually add lexicon entries if needed
-                    continue
-                for pronun in list_word_phone_seq:
-                    if self.beep:
-                        self.lexicon.append(word.lower() + ' ' + pronun.upper() + '\n')
-                    else:
-                        pronun = ' '.join(pronun)
-                        pronun = re.sub(r'[\d]', '', pronun)
-                        self.lexicon.append(word + ' ' + pronun.upper() + '\n')
-        self.lexicon = list(set(self.lexicon))
-        self.lexicon.sort()
-
-    def get_pronunciation_dict(self):
-        """ Builds the BEEP dict if using, otherwise just nabs CMUdict from nltk """
+            vocabulary.update(LEXICON_STRIP.sub('', phrase).strip('\n').split(' '))
+        del vocabulary['']
+        words = collections.Counter()
+        for word, count in vocabulary.items():
+            words[word.upper() if self.beep else word.lower()] += count
+        self.get_pronunciation_dict(sorted(words))
+
+        lexicon = {'!SIL sil\n', '<UNK> spn\n'}
+        not_in = collections.Counter()
+        for word, count in words.items():
+            pronunciations = self.dict.get(word)
+            if pronunciations is None:
+                not_in[word] = count
+                continue
+            for pronun in pronunciations:
+                lexicon.add(word.lower() + ' ' + pronun + '\n')
+        self.lexicon = sorted(lexicon)
+        self.file_writer([f'{word} {count}\n' for word, count in not_in.most_common()], self.local_dir, 'oov.txt')
+        if not_in:
+            print(f'{len(not_in)} words are not in the dictionary and were ignored, '
+                  f'see {os.path.join(self.local_dir, "oov.txt")}')
+
+    def get_pronunciation_dict(self, words):
+        """
+        Looks up the pronunciations of words in the BEEP dict if using, otherwise in CMUdict from nltk.
+        The dictionary is only parsed when it has changed: it is kept as sorted arrays of words and
+        pronunciations which are memory-mapped and binary searched, so only the vocabulary is read.
+        @param words: words to look up, upper case for BEEP and lower case for CMUdict
+        """
+        dict_words, dict_pronunciations = self.load_dict_cache()
+        keys = numpy.array([word.encode('utf-8') for word in words], dtype=bytes)
+        starts = numpy.searchsorted(dict_words, keys, side='left')
+        ends = numpy.searchsorted(dict_words, keys, side='right')
+        self.dict = {word: [pronun.decode('utf-8') for pronun in dict_pronunciations[start:end]]
+                     for word, start, end in zip(words, starts, ends) if end > start}
+
+    def load_dict_cache(self):
+        """
+        Memory-maps the cached dictionary, first building it if the source dictionary has a different mtime
+        or size to when it was cached.
+        @return: (words, pronunciations) arrays of utf-8 bytes, sorted by word
+        """
         if self.beep:
-            pronunciation_text = config.get('Paths', 'beep_path')
-            with open(pronunciation_text, 'r') as f:
-                dict_lines = f.readlines()
-            for line in dict_lines:
+            source = config.get('Paths', 'beep_path')
+        else:
+            import nltk  # only needed for CMUdict
+            source = nltk.corpus.cmudict.abspath('cmudict')
+        stat = os.stat(source)
+        signature = {'source': str(source), 'mtime': stat.st_mtime_ns, 'size': stat.st_size, 'beep': self.beep}
+        signature_path = os.path.join(self.dict_cache, 'signature.json')
+        words_path = os.path.join(self.dict_cache, 'words.npy')
+        pronunciations_path = os.path.join(self.dict_cache, 'pronunciations.npy')
+
+        cached = None
+        if os.path.isfile(signature_path):
+            with open(signature_path, 'r') as f:
+                cached = json.load(f)
+        if cached != signature:
+            pronunciations = self.read_beep(source) if self.beep else self.read_cmudict()
+            words = numpy.array([word.encode('utf-8') for word, _ in pronunciations], dtype=bytes)
+            order = numpy.argsort(words, kind='stable')  # keeps the dictionary's order of pronunciations
+            os.makedirs(self.dict_cache, exist_ok=True)
+            if os.path.isfile(signature_path):
+                os.remove(signature_path)
+            numpy.save(words_path, words[order])
+            numpy.save(pronunciations_path,
+                       numpy.array([pronun.encode('utf-8') for _, pronun in pronunciations], dtype=bytes)[order])
+            with open(signature_path, 'w') as f:
+                json.dump(signature, f)
+        return numpy.load(words_path, mmap_mode='r'), numpy.load(pronunciations_path, mmap_mode='r')
+
+    @staticmethod
+    def read_beep(pronunciation_text):
+        """
+        Parses the BEEP dict into (word, pronunciation) pairs.
+        Where a word has several pronunciations, the last one is used.
+        """
+        pronunciations = {}
+        with open(pronunciation_text, 'r') as f:
+            for line in f:
                 if line[0] == '#':
                     continue
                 if '\t' in line:
@@ -100,71 +168,152 @@ class KaldiFileMaker:
                     line = line.split(' ', 1)
                 pron = line[1].strip('\t')
                 pron = pron.strip('\n')
-                self.dict[line[0]] = [pron]
-        else:
-            self.dict = nltk.corpus.cmudict.dict()
+                pronunciations[line[0]] = pron.upper()
+        return list(pronunciations.items())
+
+    @staticmethod
+    def read_cmudict():
+        """ CMUdict from nltk as (word, pronunciation) pairs, with the stress markers removed from the phones """
+        import nltk
+        return [(word, STRESS.sub('', ' '.join(pronun)).upper()) for word, pronun in nltk.corpus.cmudict.entries()]
 
     def make_kaldi_files(self, utts, split):
         """
         Creates the files specific to the data splits, in addition to the corpus of the entire data set.
         speak2gender, utt2spk, and text.
         The contents of these files are prescribed by Kaldi.
+        The per-speaker CMVN statistics are gathered as the features are written, and written as cmvn.ark
+        and cmvn.scp, so Kaldi does not need compute_cmvn_stats.sh unless cmvn is False in the conf.ini.
+        The number of frames of each utterance is kept for utt2num_frames and utt2dur, so the archive
+        does not need to be read again for them.
         @param utts: List of utterance objects from one split
         @param split: string for which split the utt belongs to
         """
-
+        path = self.make_split_dir(split)
+        self.feats = KaldiArkWriter(os.path.join(path, 'feats.ark'), os.path.join(path, 'feats.scp'))
+        speaker_cmvn, utterance_cmvn = CmvnStats(), CmvnStats()
         for utt in utts:
             if utt.discarded:
                 continue
             self.s2g.append(utt.speaker + ' ' + utt.gender + '\n')
             self.s2g = list(set(self.s2g))
-            text_content = re.sub(r'[^\w|\s|\']', '', utt.text)
+            text_content = TEXT_STRIP.sub('', utt.text)
             text_content = text_content.lower()
             self.text.append(utt.id + ' ' + text_content)
             self.corpus.append(text_content)
             self.u2s.append(utt.id + ' ' + utt.speaker + '\n')
-            self.kaldi_features(utt)
-        self.s2g.sort()
-        self.text.sort()
-        self.u2s.sort()
+            with report.step('write', utt.id) as record:
+                written = self.feats.ark.tell()
+                self.kaldi_features(utt)
+                record['frames'] += len(utt.combined_feats)
+                record['bytes_written'] += self.feats.ark.tell() - written
+            self.num_frames.append((utt.id, len(utt.combined_feats)))
+            if self.cmvn:
+                speaker_cmvn.add(utt.speaker, utt.combined_feats)
+            if self.cmvn_per_utterance:
+                utterance_cmvn.add(utt.id, utt.combined_feats)
+        self.feats.close()
+        if self.cmvn:
+            speaker_cmvn.write(os.path.join(path, 'cmvn.ark'), os.path.join(path, 'cmvn.scp'))
+        else:
+            # statistics of earlier features would be used by run.sh and test.sh instead of computing them
+            for name in ['cmvn.ark', 'cmvn.scp']:
+                if os.path.isfile(os.path.join(path, name)):
+                    os.remove(os.path.join(path, name))
+        if self.cmvn_per_utterance:
+            utterance_cmvn.write(os.path.join(path, 'cmvn_utt.ark'), os.path.join(path, 'cmvn_utt.scp'))
         self.write_files(split)
 
         # prepare for next split
         self.s2g = []
         self.text = []
         self.u2s = []
-        self.feats = []
+        self.num_frames = []
+        self.feats = None
 
-    def write_files(self, split):
-        """ Writes files which are specific to a data split """
-        path = os.path.join("data", split)
+    def make_split_dir(self, split):
+        """ Makes the data dir for a split if it does not exist yet and returns its path """
+        path = os.path.join(self.data_dir, split)
         if not os.path.isdir(path):
             os.mkdir(path)
+        return path
+
+    def write_files(self, split):
+        """
+        Writes files which are specific to a data split, with what utils/utt2spk_to_spk2utt.pl, feat-to-len
+        and utils/fix_data_dir.sh would add: spk2utt, utt2num_frames and utt2dur, and every file sorted by key
+        in the C locale's order. The split's data dir is then checked as utils/validate_data_dir.sh would.
+        feats.ark, feats.scp and the CMVN statistics are streamed separately.
+        """
+        path = self.make_split_dir(split)
+
+        speakers = {}
+        for line in self.u2s:
+            utt_id, speaker = line.split()
+            speakers.setdefault(speaker, []).append(utt_id)
+        spk2utt = [speaker + ' ' + ' '.join(sort_by_key(utt_ids)) + '\n' for speaker, utt_ids in speakers.items()]
+        num_frames = [f'{utt_id} {frames}\n' for utt_id, frames in self.num_frames]
+        durations = [f'{utt_id} {frames * self.frame_shift:.6g}\n' for utt_id, frames in self.num_frames]
 
-        files_to_write = [self.s2g, self.text, self.u2s, self.feats, str(self.frame_shift)]
-        file_names = ['spk2gender', 'text', 'utt2spk', 'feats.txt', 'frame_shift']
+        files_to_write = [self.s2g, self.text, self.u2s, spk2utt, num_frames, durations]
+        file_names = ['spk2gender', 'text', 'utt2spk', 'spk2utt', 'utt2num_frames', 'utt2dur']
         for file_content, name in zip(files_to_write, file_names):
-            self.file_writer(file_content, path, name)
+            self.file_writer(sort_by_key(file_content), path, name)
+        self.file_writer(str(self.frame_shift), path, 'frame_shift')
+        self.validate_data_dir(path)
+
+    @staticmethod
+    def validate_data_dir(path):
+        """
+        Checks a split's data dir the way utils/validate_data_dir.sh --no-wav does, without reading the features:
+        every file is sorted and unique by key, the files list the same utterances and speakers, spk2utt is
+        the inverse of utt2spk, and utt2spk is also sorted by speaker, which Kaldi needs to split the data.
+        @raise ValueError: listing every problem found
+        """
+        problems = []
+        tables = {}
+        for name in ['utt2spk', 'spk2utt', 'spk2gender', 'text', 'feats.scp', 'utt2num_frames', 'utt2dur', 'cmvn.scp']:
+            file_name = os.path.join(path, name)
+            if not os.path.isfile(file_name):
+                if name != 'cmvn.scp':
+                    problems.append(f'{name} is missing')
+                continue
+            with open(file_name, 'r') as f:
+                rows = [line.rstrip('\n').split(' ', 1) for line in f]
+            keys = [row[0] for row in rows]
+            # an utterance may have no words, but every other file needs a value for each key
+            if any(not row[0] or name != 'text' and (len(row) < 2 or not row[1].strip()) for row in rows):
+                problems.append(f'{name} has lines without a key and a value')
+            if sort_by_key(keys) != keys or len(set(keys)) != len(keys):
+                problems.append(f'{name} is not sorted and unique by key')
+            tables[name] = {row[0]: row[1] if len(row) == 2 else '' for row in rows}
+
+        utt2spk = tables.get('utt2spk', {})
+        for name in ['text', 'feats.scp', 'utt2num_frames', 'utt2dur']:
+            if name in tables and tables[name].keys() != utt2spk.keys():
+                problems.append(f'{name} and utt2spk do not list the same utterances')
+        spk2utt = {speaker: utt_ids.split() for speaker, utt_ids in tables.get('spk2utt', {}).items()}
+        if {(utt_id, speaker) for speaker, utt_ids in spk2utt.items() for utt_id in utt_ids} != set(utt2spk.items()):
+            problems.append('spk2utt is not the inverse of utt2spk')
+        for name in ['spk2gender', 'cmvn.scp']:
+            if name in tables and tables[name].keys() != spk2utt.keys():
+                problems.append(f'{name} and spk2utt do not list the same speakers')
+        if any(gender not in ('m', 'f') for gender in tables.get('spk2gender', {}).values()):
+            problems.append('spk2gender has genders other than m and f')
+        speakers = list(utt2spk.values())
+        if sort_by_key(speakers) != speakers:
+            problems.append('utt2spk is not sorted by speaker as well as by utterance, speaker ids should prefix '
+                            'utterance ids')
+        if problems:
+            raise ValueError(f'Invalid Kaldi data dir {path}: ' + '; '.join(problems))
 
     def kaldi_features(self, utt):
         """
-        Turns the numpy matrices within the feature dict into a text format which Kaldi expects.
-        I.e. utt_id [ 0 1 .001 .2 .03 0... ]
+        Streams the utterance's feature matrix into the split's binary ark, as a Kaldi float matrix.
+        The byte offset is recorded for feats.scp, so Kaldi can read the features without copy-feats.
         @param utt: utterance object
         """
-        feats = ''
-        feats += utt.id + ' [ '
-        first = True
-        for row in utt.combined_feats:
-            row_string = ' '.join(str(e) for e in row)
-            if first == True:
-                feats += row_string
-                first = False
-            else:
-                feats += '\n' + row_string
-        feats += ' ]'
-        feats += '\n'
-        self.feats += feats
+        self.feats.write(utt.id, utt.combined_feats)
 
     @staticmethod
     def file_writer(file_content, path, file_name):
@@ -0,0 +1,144 @@
+import os
+import json
+import numpy
+import pandas
+
+
+class PoseCache:
+    """
+    Binary cache of the raw DLC output for one folder (i.e. one modality).
+    Every CSV in the folder is parsed once into a single float32 array of shape (total frames, columns),
+    stored as .npy and memory-mapped on later runs, with each utterance's frame offset and the column
+    labels kept in a json index. A CSV whose mtime or size has changed since it was cached is
+    parsed again the next time the cache is updated; unchanged utterances are copied across as they are.
+    A CSV whose columns differ from the rest of the folder is recorded as excluded, so it is read from
+    the CSV instead, and not parsed again until it changes.
+    """
+    def __init__(self, folder):
+        self.cache_dir = os.path.join(folder, '.pose_cache')
+        self.array_path = os.path.join(self.cache_dir, 'poses.npy')
+        self.index_path = os.path.join(self.cache_dir, 'index.json')
+        self.columns = None
+        self.entries = {}
+        self.poses = None
+
+    def load(self):
+        """ Loads the index and memory-maps the poses, if a cache exists """
+        if not os.path.isfile(self.index_path) or not os.path.isfile(self.array_path):
+            return
+        with open(self.index_path, 'r') as f:
+            index = json.load(f)
+        self.columns = [tuple(column) for column in index['columns']] if index['columns'] else None
+        self.entries = index['entries']
+        self.poses = numpy.load(self.array_path, mmap_mode='r')
+
+    def update(self, csv_index):
+        """
+        Brings the cache up to date with the CSVs found by FeatureMaker.index_csvs,
+        rebuilding it only if a CSV was added, removed or changed.
+        @param csv_index: dict of utterance id to CSV path
+        """
+        self.load()
+        stats = {}
+        for utt_id, csv_file in csv_index.items():
+            stat = os.stat(csv_file)
+            stats[utt_id] = {'csv': os.path.basename(csv_file), 'mtime': stat.st_mtime_ns, 'size': stat.st_size}
+        stale = [utt_id for utt_id, stat in stats.items() if not self.is_current(utt_id, stat)]
+        if stale or set(self.entries) != set(stats):
+            print(f'Caching DLC output for {len(stale)} utterances in {self.cache_dir}...')
+            self.rebuild(csv_index, stats, stale)
+
+    def is_current(self, utt_id, stat):
+        """ Whether an utterance is cached from the same CSV, with the same mtime and size """
+        entry = self.entries.get(utt_id)
+        return entry is not None and all(entry[key] == stat[key] for key in ['csv', 'mtime', 'size'])
+
+    def rebuild(self, csv_index, stats, stale):
+        """ Parses the stale CSVs and writes a new cache alongside the unchanged utterances """
+        stale = set(stale)
+        kept = {utt_id for utt_id in stats if utt_id in self.entries and utt_id not in stale}
+        if all(self.entries[utt_id].get('excluded') for utt_id in kept):
+            # no poses are kept, so the columns are those of the CSVs now in the folder,
+            # which the CSVs excluded for their columns may now have
+            self.columns = None
+            stale |= kept
+            kept = set()
+        excluded = {utt_id for utt_id in kept if self.entries[utt_id].get('excluded')}
+        parsed = {}
+        for utt_id in sorted(stale):
+            columns, data = self.read_csv(csv_index[utt_id])
+            if self.columns is None:
+                self.columns = columns
+            if columns != self.columns:
+                print(f'{csv_index[utt_id]} has different columns to the rest of the folder, it will not be cached')
+                excluded.add(utt_id)
+                continue
+            parsed[utt_id] = data
+
+        entries = {}
+        offset = 0
+        for utt_id in sorted(stats):
+            if utt_id in excluded:
+                entries[utt_id] = dict(stats[utt_id], excluded=True)
+                continue
+            if utt_id in parsed:
+                frames = parsed[utt_id].shape[0]
+            elif utt_id in kept:
+                frames = self.entries[utt_id]['frames']
+            else:
+                continue
+            entries[utt_id] = dict(stats[utt_id], start=offset, frames=frames)
+            offset += frames
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        temp_path = self.array_path + '.tmp.npy'
+        shape = (offset, len(self.columns or []))
+        if offset:
+            poses = numpy.lib.format.open_memmap(temp_path, mode='w+', dtype=numpy.float32, shape=shape)
+            for utt_id, entry in entries.items():
+                if entry.get('excluded'):
+                    continue
+                rows = slice(entry['start'], entry['start'] + entry['frames'])
+                poses[rows] = parsed[utt_id] if utt_id in parsed else self.get(utt_id)
+            poses.flush()
+            del poses
+        else:
+            numpy.save(temp_path, numpy.empty(shape, dtype=numpy.float32))
+        self.poses = None
+        os.replace(temp_path, self.array_path)
+        with open(self.index_path, 'w') as f:
+            json.dump({'columns': self.columns, 'entries': entries}, f)
+        self.load()
+
+    @staticmethod
+    def read_csv(csv_file):
+        """
+        Parses a DLC CSV. The three header rows are scorer, body part and coordinate,
+        and columns are labelled (body part, coordinate) as pandas.read_csv(header=[1, 2]) does.
+        """
+        with open(csv_file, 'r') as f:
+            f.readline()
+            parts = f.readline().rstrip('\n').split(',')
+            coordinates = f.readline().rstrip('\n').split(',')
+        data = pandas.read_csv(csv_file, skiprows=3, header=None, dtype=numpy.float32).to_numpy()
+        return list(zip(parts, coordinates)), data
+
+    @staticmethod
+    def write_csv(csv_file, scorer, bodyparts, poses):
+        """
+        Writes poses the way DLC saves them, so read_csv and pandas read them back the same.
+        @param poses: (frames, 3 * body parts) array of x, y and likelihood of each part
+        """
+        with open(csv_file, 'w') as f:
+            f.write('scorer,' + ','.join([scorer] * 3 * len(bodyparts)) + '\n')
+            f.write('bodyparts,' + ','.join(part for part in bodyparts for _ in range(3)) + '\n')
+            f.write('coords,' + ','.join(['x', 'y', 'likelihood'] * len(bodyparts)) + '\n')
+            numpy.savetxt(f, numpy.column_stack([numpy.arange(len(poses)), poses]), delimiter=',',
+                          fmt=['%d'] + ['%.9g'] * poses.shape[1])
+
+    def get(self, utt_id):
+        """ The cached (frames, columns) poses for an utterance, or None if it is not cached """
+        entry = self.entries.get(utt_id)
+        if entry is None or entry.get('excluded') or self.poses is None:
+            return None
+        return self.poses[entry['start']:entry['start'] + entry['frames']]
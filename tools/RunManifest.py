@@ -0,0 +1,67 @@
+import os
+import json
+import time
+import hashlib
+
+
+def file_record(path):
+    """ Size, mtime and sha1 of an output file """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(2 ** 20), b''):
+            digest.update(block)
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'sha1': digest.hexdigest()}
+
+
+class RunManifest:
+    """
+    Records which utterances have completed which stage of the pipeline, with the outputs they produced,
+    so that an interrupted run can pick up where it stopped.
+    The manifest is an append-only json lines file: one line per completed (stage, utterance), so a crash
+    loses at most the utterance in progress. When a record appears twice, the later one wins.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.records = {}
+        if os.path.isfile(self.path):
+            with open(self.path, 'r') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # a line cut short by a crash
+                    self.records[(record['stage'], record['utt'])] = record
+
+    def is_done(self, stage, utt_id, verify=False):
+        """
+        Whether an utterance has completed a stage and its outputs are still as they were recorded.
+        Outputs are compared by size and mtime, and also by checksum if verify is set.
+        """
+        record = self.records.get((stage, utt_id))
+        if record is None:
+            return False
+        for path, recorded in record['outputs'].items():
+            if not os.path.isfile(path):
+                return False
+            stat = os.stat(path)
+            if stat.st_size != recorded['size'] or stat.st_mtime_ns != recorded['mtime']:
+                return False
+            if verify and file_record(path)['sha1'] != recorded['sha1']:
+                return False
+        return True
+
+    def mark_done(self, stage, utt_id, outputs=()):
+        """
+        Records that an utterance has completed a stage.
+        @param outputs: paths of the files the stage produced for the utterance
+        """
+        record = {'stage': stage, 'utt': utt_id, 'time': time.time(),
+                  'outputs': {path: file_record(path) for path in outputs}}
+        self.records[(stage, utt_id)] = record
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+    def pending(self, stage, utterances):
+        """ The utterances which have not completed a stage """
+        return [utt for utt in utterances if not self.is_done(stage, utt.id)]
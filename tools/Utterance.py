@@ -1,14 +1,15 @@
 import numpy
-import os
-
-import numpy as np
-from sklearn.preprocessing import StandardScaler
 
 
 class Utterance:
     """
     Holds all the information about each utterance in the TaL corpus including speaker, gender, split etc.
+    Utterances are slotted, as there is one per utterance in the corpus. Once the combined features have been
+    added to the FeatureStore, they are read from there rather than kept on the object.
     """
+    __slots__ = ('id', 'modality', 'split', 'text', 'speaker', 'utt_id', 'gender', 'duration', 'base_path',
+                 'lip_features', 'us_features', '_combined_feats', 'feature_store', 'feature_index', 'discarded')
+
     def __init__(self, id, modality, text, base_path):
         self.id = id
         self.modality = modality
@@ -20,16 +21,42 @@ class Utterance:
         self.base_path = base_path
         self.lip_features = []
         self.us_features = []
-        self.combined_feats = None
+        self._combined_feats = None
+        self.feature_store = None
+        self.feature_index = -1
         self.discarded = False
 
+    @property
+    def combined_feats(self):
+        if self.feature_store is not None:
+            return self.feature_store.get(self.feature_index)
+        return self._combined_feats
+
+    @combined_feats.setter
+    def combined_feats(self, matrix):
+        self._combined_feats = matrix
+        self.feature_store = None
+
+    def store_features(self, feature_store):
+        """ Moves the combined features into the contiguous store, releasing the utterance's own copy """
+        if self._combined_feats is not None:
+            self.feature_index = feature_store.append(self._combined_feats)
+            self.feature_store = feature_store
+            self._combined_feats = None
+
     def feature_combiner(self):
-        """ Combines the lip and US features into one matrix, and normalizes it wrt mean and std """
+        """
+        Combines the lip and US features into one matrix, and normalizes it wrt mean and std,
+        as sklearn's StandardScaler did: a dimension which does not vary is only centred.
+        The separate lip and US features are released once combined.
+        """
         if len(self.lip_features) and len(self.us_features):
-            matrix = numpy.concatenate([self.lip_features, self.us_features], axis=1)
-            matrix = numpy.vstack(matrix).astype(float)
-            std_slc = StandardScaler()
-            X_std = std_slc.fit_transform(matrix)
-            self.combined_feats = X_std
+            matrix = numpy.concatenate([self.lip_features, self.us_features], axis=1).astype(float)
+            mean = matrix.mean(axis=0)
+            std = matrix.std(axis=0)
+            std[std < 10 * numpy.finfo(std.dtype).eps] = 1.0
+            self.combined_feats = (matrix - mean) / std
         else:
-            self.discarded = True # to track what was thrown out
\ No newline at end of file
+            self.discarded = True # to track what was thrown out
+        self.lip_features = []
+        self.us_features = []
@@ -1,11 +1,27 @@
 import os
-import itertools
+import multiprocessing
+import time
+import numpy
 from tools.KaldiFileMaker import KaldiFileMaker
-from tools.VideoMaker import VideoMaker
 from tools.FeatureMaker import FeatureMaker
+from tools.DlcScheduler import DlcScheduler
+from tools.FeatureCache import FeatureCache, code_version
+from tools.FeatureStore import FeatureStore
+from tools.RunManifest import RunManifest
+from tools.CorpusIndexer import CorpusIndexer
+from tools import pose_filters
 from tools.config_manager import config
 from tools.Utterance import Utterance
+from tools.run_report import report
 
+# body parts tracked by the DLC models for Speech Production
+TONGUE_ANATOMY = ['vallecula', 'tongueRoot1', 'tongueRoot2', 'tongueBody1', 'tongueBody2', 'tongueDorsum1',
+                  'tongueDorsum2', 'tongueBlade1', 'tongueBlade2', 'tongueTip1', 'tongueTip2', 'hyoid',
+                  'mandible', 'shortTendon']
+LIP_ANATOMY = ['leftLip', 'rightLip', 'topleftinner', 'bottomleftinner', 'toprightinner', 'bottomrightinner',
+               'topmidinner', 'bottommidinner']
+# stages of forward, in order. Like the stage variable in run.sh, a run can start from any of them
+STAGES = ['videos', 'dlc', 'features', 'kaldi']
 
 class UtteranceController:
     """
@@ -16,64 +32,61 @@ class UtteranceController:
     def __init__(self, make_features=True):
         self.tal_path = config.get('Paths','tal_path')
         self.video_path = config.get('Paths', 'video_and_csv_path')
+        self.corpus_manifest = config.get('Paths', 'corpus_manifest',
+                                          fallback=os.path.join(self.video_path, 'corpus_manifest.txt'))
+        self.index_workers = config.getint('Run', 'index_workers', fallback=16)
         self.us_video_path = os.path.join(self.video_path, 'USVideo')
         self.lip_video_path = os.path.join(self.video_path, 'LipVideo')
         self.dlc_project = config.get('Paths', 'DLC_project')
         self.utterance_list = []
-        self.tongue_anatomy = ['vallecula', 'tongueRoot1', 'tongueRoot2', 'tongueBody1', 'tongueBody2', 'tongueDorsum1',
-                  'tongueDorsum2', 'tongueBlade1', 'tongueBlade2', 'tongueTip1', 'tongueTip2', 'hyoid',
-                  'mandible', 'shortTendon']
-        self.lip_anatomy = ['leftLip', 'rightLip', 'topleftinner', 'bottomleftinner', 'toprightinner', 'bottomrightinner',
-               'topmidinner', 'bottommidinner']
+        self.tongue_anatomy = TONGUE_ANATOMY
+        self.lip_anatomy = LIP_ANATOMY
         self.make_features = make_features
         self.shared_text = []
+        self.feature_cache = None
+        if config.getboolean('PostDLC', 'feature_cache', fallback=True):
+            self.feature_cache = FeatureCache(os.path.join(self.video_path, '.feature_cache'),
+                                              config.getint('PostDLC', 'feature_cache_mb', fallback=2048) * 2 ** 20)
+        self.feature_workers = config.getint('PostDLC', 'feature_workers', fallback=1)
+        self.feature_store = FeatureStore()
+        self.streaming = config.getboolean('Run', 'streaming', fallback=False)
+        self.report_dir = config.get('Run', 'report_dir', fallback=self.video_path)
+        self.manifest = RunManifest(os.path.join(self.video_path, 'run_manifest.jsonl'))
+        self.pipelined_dlc = config.getboolean('DLC', 'pipelined', fallback=True)
+        self.dlc_batch_size = config.getint('DLC', 'batch_size', fallback=64)
+        self.dlc_queue_size = config.getint('DLC', 'queue_size', fallback=256)
+        self.dlc_analyzer = None  # deeplabcut.analyze_videos unless replaced, e.g. by a stub on CPU
+        self.dlc_backend = config.get('DLC', 'backend', fallback='videos')
+        self.frame_batch_size = config.getint('DLC', 'frame_batch_size', fallback=32)
+        self.frame_queue_size = config.getint('DLC', 'frame_queue_size', fallback=16)
+        self.pose_estimators = None  # (US, lip) pose estimators for the frames backend, loaded when first needed
 
     def make_utts(self):
         """
-        Walks through the TaL corpus and creates the utterance objects, and builds the list of utterance
-        objects.
-        If the tal_path points to a file, it will assume the format of utt_id text and try to build
-        the utterance objects that way.
+        Indexes the TaL corpus and creates the utterance objects, and builds the list of utterance
+        objects. The index is kept in the corpus manifest, so later runs only list the speaker folders
+        and read the text of new or changed utterances.
+        If the tal_path points to a file, it will assume it is a corpus manifest or has the format
+        utt_id text, and try to build the utterance objects that way.
         Also builds a list of text shared across modalities to use for making sets.
         """
         silent = []
         modal = []
 
         if os.path.isdir(self.tal_path):
-            for folder in os.listdir(self.tal_path):
-                folder_name = os.path.join(self.tal_path, folder)
-                for file_name in os.listdir(folder_name):
-                    [utt_id, ext] = file_name.split('.')
-                    # should be one param file for every utterance
-                    if ext == 'param':
-                        base_path = os.path.join(folder_name, utt_id)
-                        utt_name = folder + '-' + utt_id
-                        with open(base_path + '.txt', 'r') as f:
-                            text = f.readline()
-                            if 'sil' in utt_name:
-                                utterance = Utterance(utt_name, 'silent', text, base_path)
-                                self.utterance_list.append(utterance)
-                                silent.append(text)
-                            elif 'aud' in utt_name:
-                                utterance = Utterance(utt_name, 'modal', text, base_path)
-                                self.utterance_list.append(utterance)
-                                modal.append(text)
-                    else:
-                        continue
-
+            records = CorpusIndexer(self.tal_path, self.corpus_manifest, self.index_workers).index()
         elif os.path.isfile(self.tal_path):
-            with open(self.tal_path, 'r') as f:
-                utterances = f.readlines()
-            for line in utterances:
-                [utt_id, text] = line.split(' ', 1)
-                if 'sil' in utt_id:
-                    utterance = Utterance(utt_id, 'silent', text, base_path=None)
-                    self.utterance_list.append(utterance)
-                    silent.append(text)
-                elif 'aud' in utt_id:
-                    utterance = Utterance(utt_id, 'modal', text, base_path=None)
-                    self.utterance_list.append(utterance)
-                    modal.append(text)
+            records = CorpusIndexer.load(self.tal_path)
+        else:
+            records = []
+
+        for record in records:
+            utterance = Utterance(record['id'], record['modality'], record['text'], record['base_path'])
+            self.utterance_list.append(utterance)
+            if utterance.modality == 'silent':
+                silent.append(utterance.text)
+            else:
+                modal.append(utterance.text)
 
         silent = set(silent)
         modal = set(modal)
@@ -82,67 +95,353 @@ class UtteranceController:
     def make_sets(self):
         """
         Determines the split of the utterances. Utterances which share text in different modalities
-        are labelled with a test split.
+        are labelled with a test split. Silent utterances which do not share text belong to no split
+        and are dropped from the list.
         """
-        none_utts = []
+        shared = numpy.array([utt.text in self.shared_text for utt in self.utterance_list], dtype=bool)
+        silent = numpy.array([utt.modality == 'silent' for utt in self.utterance_list], dtype=bool)
+        splits = numpy.where(shared, numpy.where(silent, 'sil_test', 'mod_test'), numpy.where(silent, '', 'train'))
+        keep = numpy.flatnonzero(splits != '')
+        for i in keep:
+            self.utterance_list[i].split = str(splits[i])
+        self.utterance_list = [self.utterance_list[i] for i in keep]
 
-        for utt in self.utterance_list:
-            if utt.text in self.shared_text:
-                if utt.modality == 'silent':
-                    utt.split = 'sil_test'
-                if utt.modality == 'modal':
-                    utt.split = 'mod_test'
-            else:
-                if utt.modality == 'modal':
-                    utt.split = 'train'
-                else:
-                    none_utts.append(utt)
+    def make_videos(self, on_done=None, utterances=None, keep_frames=False):
+        """
+        Make videos of all the utterances in the list which do not have up to date videos yet
+        @param on_done: called with each utterance as its videos are made, and its frames if kept
+        @param utterances: the utterances to make videos of, instead of the whole list
+        @param keep_frames: keep each utterance's frames for on_done, remaking up to date videos too
+        """
+        from tools.VideoMaker import VideoMaker  # video dependencies are only needed when making videos
+        video_maker = VideoMaker(self.us_video_path, self.lip_video_path)
+        video_maker.manifest = self.manifest
+        video_maker.on_done = on_done
+        video_maker.keep_frames = keep_frames
+        video_maker.video_handler(self.utterance_list if utterances is None else utterances)
 
-        for utt in none_utts:
-            self.utterance_list.remove(utt)
+    def make_videos_with_dlc(self):
+        """
+        Makes the videos and runs DLC on them at the same time: each utterance is queued for DLC as soon
+        as its videos are made, and DLC analyses the queue in batches while the next videos are rendered.
+        Utterances whose videos were already made but which have no up to date CSVs are queued first.
+        With the frames backend, the frames are queued instead and go straight to the pose estimators,
+        and videos are only written if write_videos is set in the conf.ini, e.g. to check them.
+        """
+        pending = self.manifest.pending('dlc', [utt for utt in self.utterance_list if not utt.discarded])
+        if not pending:
+            print('DLC output is up to date')
+            if self.dlc_backend != 'frames':
+                self.make_videos()
+            return
+        needs_dlc = {utt.id for utt in pending}
+        feature_makers = self.feature_makers()
+        if self.dlc_backend == 'frames':
+            # half of the frames held are in the batch DLC is working on, half wait in the queue
+            held = max(self.frame_queue_size // 2, 1)
+            scheduler = DlcScheduler(feature_makers, held, held, load_estimators=self.make_pose_estimators).start()
+            self.render_for_dlc(scheduler, feature_makers, on_done=scheduler.submit, utterances=pending,
+                                keep_frames=True)
+            return
+        scheduler = DlcScheduler(feature_makers, self.dlc_batch_size, self.dlc_queue_size, self.dlc_analyzer).start()
 
-    def make_videos(self):
-        """ Make videos of all the utterances in the list """
-        video_maker = VideoMaker(self.us_video_path, self.lip_video_path)
-        video_maker.video_handler(self.utterance_list)
+        def queue_for_dlc(utt, frames=None):
+            if utt.id in needs_dlc:
+                scheduler.submit(utt, [os.path.join(maker.video_folder, f'{utt.id}.mp4') for maker in feature_makers])
+
+        self.render_for_dlc(scheduler, feature_makers, on_done=queue_for_dlc,
+                            queued=[utt for utt in pending if self.manifest.is_done('videos', utt.id)])
+
+    def render_for_dlc(self, scheduler, feature_makers, on_done, queued=(), **kwargs):
+        """
+        Makes the videos with the scheduler running DLC on them, and records the utterances DLC has analysed.
+        If DLC or rendering fails, the videos not started yet are not made, what is still queued is dropped,
+        and the scheduler is stopped all the same.
+        @param on_done: queues an utterance for the scheduler once its videos are made
+        @param queued: utterances to queue before rendering starts, as their videos are already made
+        @param kwargs: passed on to make_videos
+        """
+        failed = True
+        try:
+            for utt in queued:
+                on_done(utt)
+            self.make_videos(on_done=on_done, **kwargs)
+            failed = False
+        finally:
+            try:
+                scheduler.finish(cancel=failed)
+            finally:
+                self.mark_dlc_done(scheduler.analyzed, feature_makers)
+
+    def make_pose_estimators(self):
+        """ DLC models for the Ultrasound and Lip frames, loaded once for the whole run """
+        if self.pose_estimators is None:
+            from tools.DlcPoseEstimator import DlcPoseEstimator  # DLC is only needed when running it
+            shuffle = config.getint('DLC', 'shuffle')
+            self.pose_estimators = tuple(DlcPoseEstimator(os.path.join(self.dlc_project, project), shuffle,
+                                                          self.frame_batch_size)
+                                         for project in ['Ultrasound', 'Lips'])
+        return self.pose_estimators
+
+    def feature_makers(self):
+        """ Feature makers for the Ultrasound and Lip videos """
+        return (FeatureMaker(self.us_video_path, self.tongue_anatomy, os.path.join(self.dlc_project, 'Ultrasound')),
+                FeatureMaker(self.lip_video_path, self.lip_anatomy, os.path.join(self.dlc_project, 'Lips')))
+
+    def run_dlc(self):
+        """
+        Runs DLC over the Lip and Ultrasound videos, unless every utterance already has up to date CSVs.
+        DLC itself skips videos which it has already analysed.
+        """
+        pending = self.manifest.pending('dlc', [utt for utt in self.utterance_list if not utt.discarded])
+        if not pending:
+            print('DLC output is up to date')
+            return
+        feature_makers = self.feature_makers()
+        for feature_maker in reversed(feature_makers):
+            with report.step('dlc'):
+                feature_maker.run_DLC(analyzer=self.dlc_analyzer)
+        self.mark_dlc_done(pending, feature_makers)
+
+    def mark_dlc_done(self, utterances, feature_makers):
+        """ Records the utterances which have both CSVs in the run manifest """
+        US_feature_maker, lip_feature_maker = feature_makers
+        US_feature_maker.index_csvs()
+        lip_feature_maker.index_csvs()
+        for utterance in utterances:
+            csv_files = [US_feature_maker.csv_index.get(utterance.id), lip_feature_maker.csv_index.get(utterance.id)]
+            if None not in csv_files:
+                self.manifest.mark_done('dlc', utterance.id, csv_files)
+
+    def prepare_feature_makers(self):
+        """ Feature makers with their CSVs indexed and pose caches up to date """
+        US_feature_maker, lip_feature_maker = self.feature_makers()
+        for feature_maker in [US_feature_maker, lip_feature_maker]:
+            feature_maker.index_csvs(self.utterance_list)
+            if feature_maker.use_pose_cache:
+                feature_maker.load_pose_cache()
+        return US_feature_maker, lip_feature_maker
 
     def set_features(self):
         """ Creates Lip and Ultrasound features for each utterance, which are combined to create one feature matrix. """
-        US_feature_maker = FeatureMaker(self.us_video_path, self.tongue_anatomy,
-                                        os.path.join(self.dlc_project, 'Ultrasound'))
-        lip_feature_maker = FeatureMaker(self.lip_video_path, self.lip_anatomy,
-                                         os.path.join(self.dlc_project, 'Lips'))
-        if self.make_features:
-            lip_feature_maker.run_DLC()
-            US_feature_maker.run_DLC()
-        for utterance in self.utterance_list:
-            US_feature_maker.process_features(utterance)
-            utterance.us_features = US_feature_maker.features
-            lip_feature_maker.process_features(utterance)
-            utterance.lip_features = lip_feature_maker.features
-            utterance.feature_combiner()
+        for utterance, combined_feats, discarded in self.feature_stream(self.utterance_list):
+            self.apply_features(utterance, combined_feats, discarded)
+        if self.feature_cache is not None:
+            self.feature_cache.evict()
+        self.feature_store.trim()
+
+    def feature_stream(self, utterances, feature_makers=None):
+        """
+        Generates the combined features of the utterances, in order, as (utterance, combined_feats, discarded).
+        Features are read from the feature cache where they are up to date, and the rest are extracted
+        (by the pool of feature workers if enabled) and added to the cache as they arrive.
+        @param feature_makers: the (US, lip) feature makers from prepare_feature_makers, made if not given
+        """
+        US_feature_maker, lip_feature_maker = feature_makers or self.prepare_feature_makers()
+        version = code_version(pose_filters, Utterance, FeatureMaker)
+        keys = []
+        for utterance in utterances:
+            key = None
+            if self.feature_cache is not None:
+                # features only change if the pose files, the filter options or the code do
+                key = FeatureCache.key(US_feature_maker.fingerprint(utterance), lip_feature_maker.fingerprint(utterance),
+                                       US_feature_maker.settings(), lip_feature_maker.settings(), version)
+            keys.append(key)
+        missing = [utterance for utterance, key in zip(utterances, keys)
+                   if key is None or not self.feature_cache.contains(key)]
+        extracted = self.extract_features(missing, US_feature_maker, lip_feature_maker)
+        next_missing = 0
+
+        for done, (utterance, key) in enumerate(zip(utterances, keys)):
+            report.progress('features', done, len(utterances))
+            if next_missing < len(missing) and utterance is missing[next_missing]:
+                next_missing += 1
+                combined_feats, discarded = next(extracted)
+            else:
+                # contains has already counted the missing keys as misses, so only the others are read
+                cached = self.feature_cache.get(key)
+                if cached is not None:
+                    yield utterance, cached if cached.size else None, not cached.size
+                    continue
+                # an entry which could not be read after all
+                combined_feats, discarded = combine_features(utterance, US_feature_maker, lip_feature_maker)
+            if key is not None:
+                # the feature cache is the checkpoint of the features stage, the run manifest does not record it
+                self.feature_cache.put(key, combined_feats)
+            yield utterance, combined_feats, discarded
+        report.progress('features', len(utterances), len(utterances))
+        extracted.close()
+
+    def apply_features(self, utterance, combined_feats, discarded):
+        """ Adds the combined features of an utterance to the feature store, or marks it as discarded """
+        if discarded:
+            utterance.discarded = True
+        else:
+            utterance.combined_feats = combined_feats
+            utterance.store_features(self.feature_store)
+
+    def extract_features(self, utterances, US_feature_maker, lip_feature_maker):
+        """
+        Extracts the combined features of the utterances, in order, as they are needed. If feature_workers
+        in the conf.ini is more than 1, utterances are handed out in chunks to a pool of processes.
+        @return: iterator of (combined_feats, discarded) in the same order as utterances
+        """
+        if self.feature_workers <= 1 or len(utterances) <= 1:
+            for utterance in utterances:
+                yield combine_features(utterance, US_feature_maker, lip_feature_maker)
+            return
+        tasks = [(utterance.id, self.tongue_anatomy, self.lip_anatomy) for utterance in utterances]
+        chunksize = max(1, len(tasks) // (self.feature_workers * 4))
+        with multiprocessing.Pool(self.feature_workers, initializer=init_feature_worker,
+                                  initargs=(self.us_video_path, self.lip_video_path, self.dlc_project)) as pool:
+            for combined_feats, discarded, steps in pool.imap(extract_utterance_task, tasks, chunksize=chunksize):
+                report.merge(steps)
+                yield combined_feats, discarded
+
+    def split_indices(self):
+        """ The indices in the utterance list of each split's utterances, by split """
+        splits = numpy.array([utt.split for utt in self.utterance_list])
+        return {str(split): numpy.flatnonzero(splits == split) for split in numpy.unique(splits) if split != ''}
 
     def make_kaldi_files(self):
         """ Creates the necessary Kaldi files from the splits determined earlier. """
         kaldi_file_maker = KaldiFileMaker()
         kaldi_file_maker.make_dirs()
-        self.utterance_list.sort(key=lambda x: x.split)
-        for split, utts in itertools.groupby(self.utterance_list, key=lambda utt: utt.split):
-            if split != '':
-                kaldi_file_maker.make_kaldi_files(utts, split)
+        for split, indices in self.split_indices().items():
+            kaldi_file_maker.make_kaldi_files([self.utterance_list[i] for i in indices], split)
         kaldi_file_maker.make_language_files()
 
-    def forward(self):
-        """ Main driver for the controller, going through all the utterance processing steps. """
+    def stream_kaldi_files(self):
+        """
+        Streams each utterance's features from the pose files straight into its split's Kaldi archive,
+        without holding the features of the whole corpus. Only the text, utt2spk and spk2gender lines
+        are kept until a split is finished, so each split's files are usable as soon as it is written.
+        Utterances are written in order of id, which is the order Kaldi sorts keys in.
+        """
+        kaldi_file_maker = KaldiFileMaker()
+        kaldi_file_maker.make_dirs()
+        feature_makers = self.prepare_feature_makers()
+        for split, indices in self.split_indices().items():
+            utts = sorted((self.utterance_list[i] for i in indices), key=lambda utt: utt.id)
+            kaldi_file_maker.make_kaldi_files(self.streamed_utterances(utts, feature_makers), split)
+            print(f'Wrote {split} to {os.path.join(kaldi_file_maker.data_dir, split)}')
+        if self.feature_cache is not None:
+            self.feature_cache.evict()
+        kaldi_file_maker.make_language_files()
+
+    def streamed_utterances(self, utterances, feature_makers):
+        """ Generates the utterances with their features set, releasing them once they have been written """
+        for utterance, combined_feats, discarded in self.feature_stream(utterances, feature_makers):
+            utterance.discarded = utterance.discarded or discarded
+            utterance.combined_feats = combined_feats
+            yield utterance
+            utterance.combined_feats = None
+
+    def forward(self, stage=0, only=None):
+        """
+        Main driver for the controller, going through all the utterance processing steps.
+        Utterances are always made, as every stage works on them. Work already recorded in the run manifest
+        is skipped, so an interrupted run can simply be started again.
+        @param stage: index in STAGES of the first stage to run, like stage in run.sh
+        @param only: name of the single stage to run instead
+        """
+        def run_stage(name):
+            if only is not None:
+                return name == only
+            return STAGES.index(name) >= stage
+
+        if not self.make_features and only in ('videos', 'dlc'):
+            print(f'make_features is False, so the {only} stage is not run: the CSVs are expected to exist already')
         print('===Making utterances from TaL Corpus===')
-        self.make_utts()
-        self.make_sets()
-        if self.make_features:
+        with report.stage('utterances'):
+            self.make_utts()
+            self.make_sets()
+        # with the frames backend, DLC needs the frames made again, as they are not kept between runs
+        with_dlc = run_stage('dlc') and (self.dlc_backend == 'frames' or self.pipelined_dlc and run_stage('videos'))
+        if self.make_features and with_dlc:
+            print('===Making videos for DLC usage, and running DLC on them as they are made===')
+            with report.stage('videos'):
+                self.make_videos_with_dlc()
+        elif self.make_features and run_stage('videos'):
             print('===Making videos for DLC usage===')
-            self.make_videos()
-        print('===Extracting and processing features===')
-        self.set_features()
-        print('===Making files to be used by Kaldi===')
-        self.make_kaldi_files()
+            with report.stage('videos'):
+                self.make_videos()
+        if self.make_features and run_stage('dlc') and not with_dlc:
+            print('===Running DLC===')
+            with report.stage('dlc'):
+                self.run_dlc()
+        if self.streaming and run_stage('kaldi'):
+            print('===Streaming features into files to be used by Kaldi===')
+            with report.stage('kaldi'):
+                self.stream_kaldi_files()
+        else:
+            # the Kaldi files need the features too, which come from the feature cache if they are up to date
+            if run_stage('features') or run_stage('kaldi'):
+                print('===Extracting and processing features===')
+                with report.stage('features'):
+                    self.set_features()
+            if run_stage('kaldi'):
+                print('===Making files to be used by Kaldi===')
+                with report.stage('kaldi'):
+                    self.make_kaldi_files()
+        if self.feature_cache is not None:
+            print(self.feature_cache.report())
+        self.write_report()
         print('===FINISHED===')
 
+    def write_report(self):
+        """ Prints the time spent in each stage and step, and writes the run report with the per-utterance breakdown """
+        print(report.summary())
+        report_path = os.path.join(self.report_dir, time.strftime('run_report_%Y%m%d-%H%M%S.json'))
+        if report.write(report_path):
+            print(f'Run report written to {report_path}')
+
+
+def combine_features(utterance, US_feature_maker, lip_feature_maker):
+    """
+    Creates the Lip and Ultrasound features for one utterance and combines them.
+    @return: (combined_feats, discarded)
+    """
+    with report.step('filter', utterance.id) as record:
+        US_feature_maker.process_features(utterance)
+        utterance.us_features = US_feature_maker.features
+        lip_feature_maker.process_features(utterance)
+        utterance.lip_features = lip_feature_maker.features
+        record['frames'] += len(utterance.us_features)
+        record['bytes_read'] += US_feature_maker.bytes_read + lip_feature_maker.bytes_read
+        utterance.feature_combiner()
+    return utterance.combined_feats, utterance.discarded
+
+
+_worker_feature_makers = {}
+
+
+def init_feature_worker(us_video_path, lip_video_path, dlc_project):
+    """ Gives each pool worker its own feature makers, reading the pose caches the main process has updated """
+    _worker_feature_makers['paths'] = (us_video_path, lip_video_path, dlc_project)
+
+
+def extract_utterance_task(task):
+    """ Pool.imap takes one argument, so the task is the arguments of extract_utterance_features """
+    return extract_utterance_features(*task)
+
+
+def extract_utterance_features(utt_id, tongue_anatomy, lip_anatomy):
+    """
+    Pool task: extracts the combined features of one utterance.
+    Feature makers are built on a worker's first task and reused for the rest.
+    @return: (combined_feats, discarded, the steps timed for the run report)
+    """
+    report.collecting = True
+    key = (tuple(tongue_anatomy), tuple(lip_anatomy))
+    if key not in _worker_feature_makers:
+        us_video_path, lip_video_path, dlc_project = _worker_feature_makers['paths']
+        feature_makers = (FeatureMaker(us_video_path, tongue_anatomy, os.path.join(dlc_project, 'Ultrasound')),
+                          FeatureMaker(lip_video_path, lip_anatomy, os.path.join(dlc_project, 'Lips')))
+        for feature_maker in feature_makers:
+            feature_maker.index_csvs()
+            if feature_maker.use_pose_cache:
+                feature_maker.load_pose_cache(update=False)
+        _worker_feature_makers[key] = feature_makers
+    utterance = Utterance(utt_id, None, None, None)
+    return combine_features(utterance, *_worker_feature_makers[key]) + (report.take_collected(),)
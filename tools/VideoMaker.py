@@ -4,25 +4,39 @@ and Aciel Eshky in the UltraSuite Tools repository.
 
 write_images_to_disk and create_video are modified versions of the same functions from animate_utterance.py
 in the UltraSuite Tools repository. They have been modified to support both the ultrasound and video data. create_video
-also now supports FFMPEG's GPU functionality.
+also now supports FFMPEG's GPU functionality. pipe_video streams the frames straight into FFMPEG instead, and
+reproduces the frames those two functions give DLC.
 
 video_handler is a combination of the animate_utterance function of the very same module,
 and of visualiser.py from the Tal Tools repository.
 
 Downsampling and trimming has been modified from the original tools.utils to support downsampling before
-trimming. The dependencies tools.io and ustools.transform_ultrasound have been reproduced
-without modification.
+trimming. The trim window is chosen from the stream lengths in the file headers, and only that window is decoded.
+The dependency tools.io has been extended with readers which probe the stream lengths and read only a window
+of each stream, and ustools.transform_ultrasound has been extended with a cached ScanConverter.
 """
 
+import math
+import multiprocessing
 import os
 import shutil
 import subprocess
-import torch
-import matplotlib.pyplot as plt
+import threading
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy
 from tools import utils
 from tools import io as myio
-from tools.transform_ultrasound import transform_ultrasound
-from tools.config_manager import config
+from tools.transform_ultrasound import get_scan_converter
+from tools.config_manager import config, config_sections
+from tools.run_report import report
+
+# write_images_to_disk draws on a (32 / 30) x 0.8 inch figure at 300 dpi, i.e. 320x240 pixels.
+# The image fills the default axes, which sit between 0.125-0.9 of the width and 0.11-0.88 of the height.
+FIGURE_SIZE = (320, 240)
+AXES_BOX = (40, 29, 248, 185)  # x, y from the top left, width, height
+# rows and columns of the scan converted ultrasound kept for DLC
+US_REGION = ((0, 650), (60, 575))
 
 
 class VideoMaker:
@@ -40,7 +54,20 @@ class VideoMaker:
         self.vid_temp = None
         self.wav_temp = None
         self.wav_sr_temp = None
-        self.temp_directory = '.temp'
+        self.wav_len_temp = None
+        self.vid_window = None
+        self.ult_window = None
+        self.wav_window = None
+        self.workers = config.getint('PreDLC', 'video_workers', fallback=1)
+        self.render = config.get('PreDLC', 'render', fallback='pipe')
+        # scratch space is per process, so that several makers can run side by side
+        self.temp_directory = f'.temp_{os.getpid()}'
+        self.failed = []
+        self.manifest = None
+        self.on_done = None  # called with each utterance whose videos are made, e.g. to queue them for DLC
+        self.write_videos = config.getboolean('PreDLC', 'write_videos', fallback=True)
+        self.keep_frames = False  # keep the frames laid out as in the videos, for a pose estimator
+        self.frames = None
 
     def write_images_to_disk(self, frames, origin):
         """
@@ -54,6 +81,8 @@ class VideoMaker:
 
         os.makedirs(self.temp_directory)
 
+        import matplotlib.pyplot as plt  # only needed to render through images
+
         print("writing image frames to disk...")
         plt.figure(dpi=300, figsize=((32 / 30), 0.8))
 
@@ -64,6 +93,7 @@ class VideoMaker:
             im.set_data(c)
             plt.axis("off")
             plt.savefig(self.temp_directory + "/%07d.jpg" % i, transparent=True, facecolor='black')
+        plt.close()
 
     def create_video(self, output_video_file):
         """
@@ -78,7 +108,7 @@ class VideoMaker:
 
         fps = str(self.target_fps)
 
-        if torch.cuda.is_available():
+        if cuda_available():
             subprocess_list = ["ffmpeg", '-hwaccel_output_format', 'cuda', '-hwaccel', 'cuda', "-y", '-r', fps,
                                "-i", self.temp_directory + "/%07d.jpg", '-qp', '5', '-c:v', 'hevc_nvenc', '-r', fps,
                                output_video_file]
@@ -87,15 +117,99 @@ class VideoMaker:
                                "-i", self.temp_directory + "/%07d.jpg", '-crf', '10', '-r', fps,
                                output_video_file]
 
-        subprocess.call(subprocess_list)
+        # a failed encode raises, so that only this utterance is lost
+        subprocess.run(subprocess_list, check=True)
+        print("Video saved.")
+
+    def pipe_video(self, frames, origin, output_video_file, chunk_size=256):
+        """
+        A function to animate video frames by streaming them into FFMPEG's stdin as raw 8 bit grayscale,
+        skipping the matplotlib drawing and the JPEG encode/decode of write_images_to_disk and create_video.
+        The frames are laid out the way those functions draw them: FFMPEG scales each frame into the
+        axes box of the 320x240 figure, flips it if the origin is 'lower', and pads the rest with white,
+        which is what the transparent figure becomes once saved as JPEG.
+        Grey levels are scaled with the first frame's range, as imshow does.
+        :param frames: video frame data as a 3d numpy array
+        :param origin: 'lower' for ultrasound, 'upper' for lip video
+        :param output_video_file: Where the video is saved
+        :param chunk_size: number of frames converted to uint8 at a time
+        """
+        height, width = frames.shape[1:]
+        fps = str(self.target_fps)
+        subprocess_list = ["ffmpeg", "-y", "-f", "rawvideo", "-pix_fmt", "gray", "-s", f"{width}x{height}",
+                           "-r", fps, "-i", "-", "-vf", ",".join(layout_filters(origin)), "-pix_fmt", "yuv420p"]
+        if cuda_available():
+            subprocess_list += ['-qp', '5', '-c:v', 'hevc_nvenc']
+        else:
+            subprocess_list += ['-crf', '10']
+        subprocess_list += ['-r', fps, output_video_file]
+
+        process = subprocess.Popen(subprocess_list, stdin=subprocess.PIPE)
+        try:
+            write_grey_levels(process.stdin, frames, chunk_size)
+        finally:
+            return_code = process.wait()
+        if return_code:
+            raise subprocess.CalledProcessError(return_code, subprocess_list)
         print("Video saved.")
 
+    def layout_frames(self, frames, origin, chunk_size=256):
+        """
+        The frames as pipe_video lays them out in the video, without encoding them: the frames are streamed
+        through the same FFMPEG filters and pixel format as the video, and read back as raw 8 bit grayscale.
+        :param frames: video frame data as a 3d numpy array
+        :param origin: 'lower' for ultrasound, 'upper' for lip video
+        :return: (frames - 1, height, width) uint8 array, the height and width of the figure
+        """
+        height, width = frames.shape[1:]
+        canvas_w, canvas_h = FIGURE_SIZE
+        # the video is padded in yuv420p, which moves the axes box to even rows and columns
+        filters = layout_filters(origin) + ['format=yuv420p']
+        subprocess_list = ["ffmpeg", "-v", "error", "-f", "rawvideo", "-pix_fmt", "gray", "-s", f"{width}x{height}",
+                           "-i", "-", "-vf", ",".join(filters), "-f", "rawvideo", "-pix_fmt", "gray", "-"]
+
+        laid_out = numpy.empty((max(frames.shape[0] - 1, 0), canvas_h, canvas_w), dtype=numpy.uint8)
+        process = subprocess.Popen(subprocess_list, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        # FFMPEG's output is read while the frames are written, so that neither pipe fills up
+        writer = threading.Thread(target=write_grey_levels, args=(process.stdin, frames, chunk_size), daemon=True)
+        writer.start()
+        buffer = memoryview(laid_out).cast('B')
+        filled = 0
+        try:
+            while filled < len(buffer):
+                read = process.stdout.readinto(buffer[filled:])
+                if not read:
+                    break
+                filled += read
+        finally:
+            process.stdout.close()
+            writer.join()
+            return_code = process.wait()
+        if return_code or filled != len(buffer):
+            raise subprocess.CalledProcessError(return_code, subprocess_list,
+                                                output=f'{filled // (canvas_w * canvas_h)} of {len(laid_out)} frames')
+        return laid_out
+
+    def make_video(self, frames, origin, output_video_file):
+        """ Renders frames to a video, either piped straight to FFMPEG or through JPEGs on disk """
+        if self.render == 'images':
+            self.write_images_to_disk(frames, origin)
+            self.create_video(output_video_file)
+        else:
+            self.pipe_video(frames, origin, output_video_file)
+
     def video_handler(self, utt_list):
         """
         Takes each utterance in the candidate list and prepares the videos for processing by DLC.
         The lip video and tongue ultrasound data are downsampled and trimmed, and the ultrasound data is transformed.
         The data are then turned into videos and saved in the format utt_id.mp4.
         Wav is also trimmed but not conserved - a future experimenter may want to use wav.
+        If video_workers in the conf.ini is more than 1, utterances are spread over a pool of processes.
+        An utterance which fails is reported and marked as discarded, the rest carry on.
+        If the maker has a run manifest, utterances whose videos are already made are skipped unless their
+        frames are to be kept, and each finished utterance is recorded in it. Each finished utterance is also
+        passed to on_done, if set, with its frames as laid out in the videos if keep_frames is set.
+        If write_videos is False in the conf.ini, the videos are not written at all, and only those frames are made.
         @param candidate_list: A list of utterance objects.
         """
 
@@ -104,37 +218,167 @@ class VideoMaker:
         if not os.path.isdir(self.lip_output_path):
             os.mkdir(self.lip_output_path)
 
-        for utt in utt_list:
-            base_path = utt.base_path
-            self.wav_temp, self.wav_sr_temp = myio.read_waveform(base_path + '.wav')
-            self.ult_temp, self.param_temp = myio.read_ultrasound_tuple(base_path, shape='3d', cast=None, truncate=None)
-            self.vid_temp, self.meta_temp = myio.read_video(base_path, shape='3d', cast=None)
+        if self.manifest is not None and not self.keep_frames:
+            pending = self.manifest.pending('videos', utt_list)
+            print(f"Videos are up to date for {len(utt_list) - len(pending)} utterances, making {len(pending)}...")
+            utt_list = pending
+
+        self.failed = []
+        if self.workers > 1:
+            # workers are spawned rather than forked, as DLC's thread, TensorFlow and CUDA may be running already
+            with ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'),
+                                     initializer=init_video_worker, initargs=(config_sections(),)) as pool:
+                futures = {pool.submit(make_videos_in_worker, self.us_output_path, self.lip_output_path, utt,
+                                       self.keep_frames): utt
+                           for utt in utt_list}
+                try:
+                    for done, future in enumerate(as_completed(futures), 1):
+                        frames = None
+                        try:
+                            error, frames, steps = future.result()
+                            report.merge(steps)
+                        except Exception:  # the worker process itself died
+                            error = traceback.format_exc()
+                        self.record_result(futures[future], error, frames)
+                        report.progress('videos', done, len(utt_list))
+                except BaseException:
+                    # e.g. on_done found DLC had failed: the utterances not started yet are not rendered
+                    pool.shutdown(wait=False, cancel_futures=True)
+                    raise
+        else:
+            for done, utt in enumerate(utt_list, 1):
+                self.record_result(utt, self.try_utterance_videos(utt), self.frames)
+                self.frames = None
+                report.progress('videos', done, len(utt_list))
+
+        if self.failed:
+            print(f"Could not make videos for {len(self.failed)} utterances: {' '.join(self.failed)}")
 
-            self.downsample()
+    def record_result(self, utt, error, frames=None):
+        """
+        Marks an utterance as discarded if its videos could not be made, or records it as done
+        @param frames: the utterance's (US, lip) frames, if they were kept
+        """
+        if error is not None:
+            print(f"Failed to make videos for {utt.id}:\n{error}")
+            utt.discarded = True
+            self.failed.append(utt.id)
+            return
+        if self.manifest is not None and self.write_videos:
+            self.manifest.mark_done('videos', utt.id, self.video_paths(utt))
+        if self.on_done is not None:
+            self.on_done(utt, frames)
+
+    def video_paths(self, utt):
+        """ Where the tongue and lip videos of an utterance are saved """
+        return (os.path.join(self.us_output_path, f"{utt.id}.mp4"),
+                os.path.join(self.lip_output_path, f"{utt.id}.mp4"))
+
+    def try_utterance_videos(self, utt):
+        """
+        Makes the videos for one utterance in this maker's own scratch directory.
+        @return: None if successful, otherwise the traceback of the failure
+        """
+        self.frames = None
+        try:
+            self.utterance_videos(utt)
+        except Exception:
+            return traceback.format_exc()
+        finally:
+            if os.path.exists(self.temp_directory):
+                shutil.rmtree(self.temp_directory)
+        return None
+
+    def utterance_videos(self, utt):
+        """
+        Reads, downsamples, trims and transforms one utterance, then writes its tongue and lip videos
+        and/or keeps their frames
+        """
+        base_path = utt.base_path
+        with report.step('decode', utt.id) as record:
+            self.probe_streams(base_path)
             self.trim_to_parallel_streams()
+            self.read_streams(base_path)
+            record['frames'] += self.vid_temp.shape[0] + self.ult_temp.shape[0]
+            # the ultrasound and wav windows are read from disk as they are stored, while the mp4 is
+            # only read from the seek point, so its share of the file is counted
+            video_share = self.vid_temp.shape[0] / max(self.meta_temp['nframes'], 1)
+            record['bytes_read'] += (self.ult_temp.nbytes + self.wav_temp.nbytes
+                                     + int(min(video_share, 1) * os.path.getsize(base_path + '.mp4')))
+
+        with report.step('resample', utt.id) as record:
+            self.downsample()
+            record['frames'] += self.vid_temp.shape[0] + self.ult_temp.shape[0]
+        with report.step('transform', utt.id) as record:
             self.manipulate_ultrasound()
+            record['frames'] += self.ult_temp.shape[0]
 
+        if self.keep_frames:
+            with report.step('layout', utt.id) as record:
+                self.frames = (self.layout_frames(self.ult_temp, 'lower'), self.layout_frames(self.vid_temp, 'upper'))
+                record['frames'] += self.ult_temp.shape[0] + self.vid_temp.shape[0]
+        if not self.write_videos:
+            return
+
+        us_video, lip_video = self.video_paths(utt)
+        with report.step('encode', utt.id) as record:
             print("Creating tongue video...")
-            self.write_images_to_disk(self.ult_temp, origin='lower')
-            self.create_video(os.path.join(self.us_output_path, f"{utt.id}.mp4"))
+            self.make_video(self.ult_temp, 'lower', us_video)
             print("Creating lip video...")
-            self.write_images_to_disk(self.vid_temp, origin='upper')
-            self.create_video(os.path.join(self.lip_output_path, f"{utt.id}.mp4"))
+            self.make_video(self.vid_temp, 'upper', lip_video)
+            record['frames'] += self.ult_temp.shape[0] + self.vid_temp.shape[0]
+            record['bytes_written'] += os.path.getsize(us_video) + os.path.getsize(lip_video)
+
+    def probe_streams(self, base_path):
+        """ Reads the stream lengths from the wav header, the .param file and the mp4 container, without decoding """
+        self.wav_len_temp, self.wav_sr_temp = myio.probe_waveform(base_path + '.wav')
+        self.param_temp = myio.probe_ultrasound(base_path)
+        self.meta_temp = myio.probe_video(base_path)
+
+    def read_streams(self, base_path):
+        """
+        Decodes only the parts of the streams which survive the trim. The trim windows are in frames at
+        the target fps, so they are mapped back to the source frame rates: the start is rounded down and
+        the end up, so the decoded frames cover the window, and the end is clamped to the frames in the file.
+        The ultrasound window starts at its first frame, so it is read from there up to its mapped end.
+        """
+        ultra_fps = self.param_temp['FramesPerSec']
+        video_fps = self.meta_temp['fps']
+
+        vid_start = math.floor(self.vid_window[0] * video_fps / self.target_fps)
+        vid_stop = min(math.ceil(self.vid_window[1] * video_fps / self.target_fps), self.meta_temp['nframes'])
+        self.vid_temp, _ = myio.read_video(base_path, shape='3d', cast=None, start_frame=vid_start,
+                                           num_frames=max(vid_stop - vid_start, 0), metadata=self.meta_temp)
+
+        ult_stop = min(math.ceil(self.ult_window[1] * ultra_fps / self.target_fps), self.param_temp['num_frames'])
+        self.ult_temp, _ = myio.read_ultrasound_frames(base_path, 0, ult_stop, params=self.param_temp)
+
+        self.wav_temp, _ = myio.read_waveform(base_path + '.wav', *self.wav_window)
 
     def manipulate_ultrasound(self):
-        """ Transforms ultrasound from US data into image data, then trimmed """
+        """
+        Transforms ultrasound from US data into image data, trimmed of the thick black border around US for DLC.
+        Only the pixels which survive the trim are computed, straight into uint8 frames.
+        """
         ult_3d = self.ult_temp.reshape(-1, int(self.param_temp['NumVectors']), int(self.param_temp['PixPerVector']))
-        ult_data = transform_ultrasound(ult_3d, background_colour=0, num_scanlines=int(self.param_temp['NumVectors']),
-                                        size_scanline=int(self.param_temp['PixPerVector']),
-                                        angle=float(self.param_temp['Angle']),
-                                        zero_offset=int(self.param_temp['ZeroOffset']), pixels_per_mm=3)
-        self.ult_temp = ult_data.transpose(0, 2, 1)[:, 0:650, 60:575]  # removes thick black border around US for DLC
+        # the geometry is the same for almost every recording, so the conversion is only precomputed once
+        scan_converter = get_scan_converter(background_colour=0, num_scanlines=int(self.param_temp['NumVectors']),
+                                            size_scanline=int(self.param_temp['PixPerVector']),
+                                            angle=float(self.param_temp['Angle']),
+                                            zero_offset=int(self.param_temp['ZeroOffset']), pixels_per_mm=3,
+                                            region=US_REGION)
+        self.ult_temp = scan_converter.convert(ult_3d, dtype=numpy.uint8)
 
     def trim_to_parallel_streams(self):
-        ''' trim data to parallel streams '''
+        '''
+        choose the window of each stream which is parallel to the others, from the stream lengths alone.
+        windows for the video and ultrasound are in frames at the target fps
+        '''
 
-        vid_len = self.vid_temp.shape[0] / self.target_fps
-        wav_len = self.wav_temp.shape[0] / self.wav_sr_temp
+        # the video is measured as it will be after downsampling
+        vid_frames = int(self.meta_temp['nframes'] * self.target_fps / self.meta_temp['fps'])
+        vid_len = vid_frames / self.target_fps
+        wav_len = self.wav_len_temp / self.wav_sr_temp
 
         # trim data streams to common start and end time stamps
         # ultrasound is always the last to start recording,
@@ -146,30 +390,78 @@ class VideoMaker:
 
         self.duration_temp = end_time - start_time
         # video
-        import math
         frame_start = math.ceil(start_time * self.target_fps)
         frame_end = math.floor(end_time * self.target_fps)
-        self.vid_temp = self.vid_temp[frame_start:frame_end, :, :]
+        self.vid_window = (frame_start, frame_end)
 
         # audio
         sample_start = int(start_time * self.wav_sr_temp)
         sample_end = int(end_time * self.wav_sr_temp)
-        self.wav_temp = self.vid_temp[sample_start:sample_end, ]
+        self.wav_window = (sample_start, sample_end)
 
         # ultrasound
-
-        frame_end = frame_end - frame_start
-        self.ult_temp = self.ult_temp[:frame_end, :, :]
+        ult_frames = int(self.param_temp['num_frames'] * self.target_fps / self.param_temp['FramesPerSec'])
+        self.ult_window = (0, min(frame_end - frame_start, ult_frames))
 
     def downsample(self):
-        '''downsample ultrasound/video to target fps '''
+        '''downsample the decoded windows of ultrasound/video to the target fps, interpolating along time only '''
         # resize ultrasound
-        ultra_fps = self.param_temp['FramesPerSec']
-        video_fps = self.meta_temp['fps']
-
-        target_ult_frames = int(self.ult_temp.shape[0] * self.target_fps / ultra_fps)
-        self.ult_temp = utils.resize(self.ult_temp, target_ult_frames)
+        self.ult_temp = utils.resize(self.ult_temp, self.ult_window[1] - self.ult_window[0], dtype=numpy.uint8)
 
         # resize video
-        target_vid_frames = int(self.vid_temp.shape[0] * self.target_fps / video_fps)
-        self.vid_temp = utils.resize(self.vid_temp, target_vid_frames)
+        self.vid_temp = utils.resize(self.vid_temp, self.vid_window[1] - self.vid_window[0], dtype=numpy.uint8)
+
+
+def layout_filters(origin):
+    """ The FFMPEG filters which lay the frames out as write_images_to_disk draws them """
+    (canvas_w, canvas_h), (box_x, box_y, box_w, box_h) = FIGURE_SIZE, AXES_BOX
+    filters = ['vflip'] if origin == 'lower' else []
+    return filters + [f'scale={box_w}:{box_h}:flags=bilinear', f'pad={canvas_w}:{canvas_h}:{box_x}:{box_y}:color=white']
+
+
+def write_grey_levels(stream, frames, chunk_size=256):
+    """
+    Writes the frames to an FFMPEG pipe as raw 8 bit grayscale, scaled with the first frame's range as imshow
+    does, and closes it. The matplotlib path never wrote frame 0, so neither does this, to keep frame counts
+    comparable. A pipe closed by FFMPEG is left for its exit code to report.
+    """
+    vmin = float(frames[0].min())
+    scale = 255 / max(float(frames[0].max()) - vmin, 1e-12)
+    try:
+        for start in range(1, frames.shape[0], chunk_size):
+            chunk = numpy.asarray(frames[start:start + chunk_size], dtype=numpy.float32)
+            stream.write(numpy.clip((chunk - vmin) * scale, 0, 255).astype(numpy.uint8).tobytes())
+    except BrokenPipeError:
+        pass
+    finally:
+        try:
+            stream.close()
+        except BrokenPipeError:
+            pass
+
+
+def cuda_available():
+    """ Whether FFMPEG can encode on the GPU. torch is only imported to check, and need not be installed """
+    try:
+        import torch
+    except ImportError:
+        return False
+    return torch.cuda.is_available()
+
+
+def init_video_worker(sections):
+    """ Gives a spawned pool worker the options of the main process, which may differ from those in conf.ini """
+    config.read_dict(sections)
+
+
+def make_videos_in_worker(us_output_path, lip_output_path, utt, keep_frames=False):
+    """
+    Entry point for pool workers. Each worker process gets its own VideoMaker, and so its own scratch directory.
+    @return: None if successful, otherwise the traceback of the failure, the frames if kept,
+             and the steps timed for the run report
+    """
+    video_maker = VideoMaker(us_output_path, lip_output_path)
+    video_maker.keep_frames = keep_frames
+    report.collecting = True
+    error = video_maker.try_utterance_videos(utt)
+    return error, video_maker.frames, report.take_collected()
@@ -1,4 +1,8 @@
 import configparser
 
 config = configparser.ConfigParser()
-config.read_file(open('conf.ini'))
\ No newline at end of file
+config.read_file(open('conf.ini'))
+
+def config_sections():
+    """ The options of every section, as read or set in this process, for processes which are spawned """
+    return {section: dict(config.items(section, raw=True)) for section in config.sections()}
@@ -10,7 +10,8 @@ Author: M. Sam Ribeiro
 
 from __future__ import print_function
 
-import imageio
+import os
+import imageio_ffmpeg
 import numpy as np
 import scipy.io.wavfile as wavfile
 
@@ -23,13 +24,22 @@ def read_text_from_file(filename):
     return [l.rstrip() for l in lines]
 
 
-def read_waveform(filename):
-    ''' read waveform '''
-    sr, wav = wavfile.read(filename)
-    wav = wav.reshape(-1, 1)
+def read_waveform(filename, start=0, end=None):
+    '''
+        read waveform
+        start, end: (int) only read samples [start, end), the rest of the file is never loaded
+    '''
+    sr, wav = wavfile.read(filename, mmap=True)
+    wav = np.array(wav[start:end]).reshape(-1, 1)
     return wav, sr
 
 
+def probe_waveform(filename):
+    ''' read the number of samples and sample rate from the wav header, without reading samples '''
+    sr, wav = wavfile.read(filename, mmap=True)
+    return wav.shape[0], sr
+
+
 def read_ultrasound_param(filename):
     ''' read ultrasound parameters from file'''
     params = {}
@@ -57,6 +67,25 @@ def read_ultrasound_data(filename):
     return ultrasound
 
 
+def probe_ultrasound(path):
+    ''' read ultrasound parameters, plus the number of frames from the size of the .ult file '''
+    params = read_ultrasound_param(path + '.param')
+    params['num_frames'] = os.path.getsize(path + '.ult') // params['frame_size']
+    return params
+
+
+def read_ultrasound_frames(path, start=0, stop=None, params=None):
+    '''
+        memory-map the ultrasound data and read only frames [start, stop)
+        returns uint8 ultrasound of shape (frames, scanlines, echos) and the parameters
+    '''
+    if params is None:
+        params = probe_ultrasound(path)
+    ultrasound = np.memmap(path + '.ult', dtype=np.uint8, mode='r',
+                           shape=(params['num_frames'], params['scanlines'], params['echos']))
+    return np.array(ultrasound[start:stop]), params
+
+
 def read_ultrasound_tuple(path, shape='2d', cast=None, truncate=None):
     '''
         read ultrasound data and parameters
@@ -87,43 +116,99 @@ def read_ultrasound_tuple(path, shape='2d', cast=None, truncate=None):
     return ultrasound, params
 
 
-def read_video(path, shape='3d', cast=None) -> object:
+def _gray_frames(filename, start_time=None, num_frames=None):
     '''
-        read video data and parameters
-        shape '2d': (frames, frame_size)
-              anything else defaults to '3d' (frames, width, height)
+        start a single sequential ffmpeg decode of a video, asking for 8 bit gray (Y) output
+        start_time: (float) seek to this time before decoding
+        num_frames: (int) stop decoding after this many frames
+        returns the metadata and a generator over the raw bytes of each frame
     '''
-    filename   = path + '.mp4'
-    reader = imageio.get_reader(filename,  'ffmpeg')
+    input_params = ['-ss', '%.6f' % start_time] if start_time else None
+    output_params = ['-frames:v', str(num_frames)] if num_frames is not None else None
+    generator = imageio_ffmpeg.read_frames(filename, pix_fmt='gray', bpp=1,
+                                           input_params=input_params, output_params=output_params)
+    metadata = generator.__next__()
+    return metadata, generator
 
-    # we can get some metadata for the video file
-    # things like: fps, size, codec, duration, plugin, pix_fmt
-    metadata = reader.get_meta_data()
-    # this method estimates the number of frames using ffmpeg
-    # might be longer for big files
-    number_frames = reader.count_frames()
-    frames = []
-    for i in range(number_frames):
-        image = reader.get_data(i)
-        # convert frame to numpy array
-        # shape will be (X,Y,3), where X,Y are image dimensions and 3 is YUV channels
 
-        # we can sum all three channels
-        frame = image.sum(axis=2)
+def probe_video(path):
+    '''
+        read video metadata from the container, without decoding any frames
+        'nframes' is estimated from the duration and frame rate
+    '''
+    metadata, generator = _gray_frames(path + '.mp4')
+    generator.close()
+    metadata['nframes'] = int(round(metadata['duration'] * metadata['fps']))
+    return metadata
 
-        # # or we take only the Y channel
-        # frame = np.asarray(image)[:,:,0]
 
-        frames.append(frame)
+def read_video_chunks(path, chunk_size=256):
+    '''
+        stream video frames as uint8 grayscale, decoded in one sequential pass
+        returns the metadata and a generator over chunks of shape (<= chunk_size, height, width)
+    '''
+    metadata, generator = _gray_frames(path + '.mp4')
+    width, height = metadata['size']
+
+    def chunks():
+        chunk = np.empty((chunk_size, height, width), dtype=np.uint8)
+        n = 0
+        for frame in generator:
+            chunk[n] = np.frombuffer(frame, dtype=np.uint8).reshape(height, width)
+            n += 1
+            if n == chunk_size:
+                yield chunk
+                chunk = np.empty((chunk_size, height, width), dtype=np.uint8)
+                n = 0
+        if n:
+            yield chunk[:n]
+
+    return metadata, chunks()
+
+
+def read_video(path, shape='3d', cast=None, start_frame=0, num_frames=None, metadata=None) -> object:
+    '''
+        read video data and parameters
+        frames are the uint8 gray (Y) channel, decoded in a single sequential pass
+        into a preallocated array
+        shape '2d': (frames, frame_size)
+              anything else defaults to '3d' (frames, height, width)
+        start_frame, num_frames: (int) only decode this window of frames
+        metadata: (dict) from probe_video, so the video need not be probed again to seek to start_frame
+    '''
+    filename   = path + '.mp4'
 
-    frames = np.stack(frames, axis=0)
+    # seek to half a frame before the first one we want, so that it is the first one decoded
+    start_time = None
+    if start_frame > 0:
+        fps = (metadata or probe_video(path))['fps']
+        start_time = (start_frame - 0.5) / fps
+
+    # we can get some metadata for the video file
+    # things like: fps, size, codec, duration, pix_fmt
+    metadata, generator = _gray_frames(filename, start_time, num_frames)
+    width, height = metadata['size']
+
+    # the container duration gives the frame count without decoding the file twice,
+    # the buffer grows in case it is an underestimate
+    if num_frames is not None:
+        capacity = max(num_frames, 1)
+    else:
+        capacity = int(round(metadata['duration'] * metadata['fps'])) + 1
+    frames = np.empty((capacity, height, width), dtype=np.uint8)
+    number_frames = 0
+    for frame in generator:
+        if number_frames == frames.shape[0]:
+            grown = np.empty((2 * frames.shape[0], height, width), dtype=np.uint8)
+            grown[:number_frames] = frames
+            frames = grown
+        frames[number_frames] = np.frombuffer(frame, dtype=np.uint8).reshape(height, width)
+        number_frames += 1
+    frames = frames[:number_frames]
 
     if cast:
         frames = frames.astype(cast)
 
     if shape == '2d':
-        size = metadata['size']
-        frames = frames.reshape((number_frames, size[0]*size[1]))
-    reader.close()
+        frames = frames.reshape((number_frames, width*height))
     return frames, metadata
-
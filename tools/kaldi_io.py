@@ -0,0 +1,120 @@
+"""
+Reading and writing of Kaldi binary archives.
+
+Features are written as Kaldi binary float matrices ("\\0B" followed by the "FM " token),
+so the archive and its scp index can be used by Kaldi directly, without a copy-feats pass.
+"""
+
+import os
+import struct
+import numpy
+
+BINARY_HEADER = b'\0B'
+INT32_SIZE = b'\4'
+MATRIX_TOKENS = {b'FM ': numpy.dtype('<f4'), b'DM ': numpy.dtype('<f8')}
+
+
+class KaldiArkWriter:
+    """
+    Streams matrices into a Kaldi binary ark file, and records the byte offset of each one
+    so that a matching scp file can be written. Kaldi expects scp files sorted by key, so the
+    scp entries are sorted when the writer is closed.
+    """
+    def __init__(self, ark_path, scp_path):
+        self.ark_path = ark_path
+        self.scp_path = scp_path
+        self.scp_entries = []
+        self.ark = open(ark_path, 'wb')
+
+    def write(self, key, matrix, double=False):
+        """
+        Appends one matrix to the ark as a binary float matrix.
+        @param key: utterance id
+        @param matrix: 2d array-like of shape (frames, dims)
+        @param double: write a double matrix instead, e.g. for CMVN statistics
+        """
+        token = b'DM ' if double else b'FM '
+        matrix = numpy.ascontiguousarray(matrix, dtype=MATRIX_TOKENS[token])
+        if matrix.ndim != 2:
+            raise ValueError(f'Kaldi matrices must be 2d, got shape {matrix.shape} for {key}')
+        self.ark.write(key.encode('utf-8') + b' ')
+        offset = self.ark.tell()
+        self.ark.write(BINARY_HEADER + token)
+        self.ark.write(INT32_SIZE + struct.pack('<i', matrix.shape[0]))
+        self.ark.write(INT32_SIZE + struct.pack('<i', matrix.shape[1]))
+        self.ark.write(matrix.tobytes())
+        self.scp_entries.append(f'{key} {self.ark_path}:{offset}\n')
+
+    def close(self):
+        """ Closes the ark and writes the sorted scp """
+        self.ark.close()
+        self.scp_entries.sort()
+        with open(self.scp_path, 'w') as f:
+            f.writelines(self.scp_entries)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def _read_int32(f):
+    size = f.read(1)
+    if size != INT32_SIZE:
+        raise ValueError(f'Expected int32 size marker in {f.name}, got {size!r}')
+    return struct.unpack('<i', f.read(4))[0]
+
+
+def _read_matrix(f):
+    """ Reads one binary matrix from the current position, which must point at the binary header """
+    header = f.read(2)
+    if header != BINARY_HEADER:
+        raise ValueError(f'Only binary Kaldi matrices are supported, got header {header!r} in {f.name}')
+    token = f.read(3)
+    if token not in MATRIX_TOKENS:
+        raise ValueError(f'Unsupported matrix type {token!r} in {f.name}')
+    dtype = MATRIX_TOKENS[token]
+    rows = _read_int32(f)
+    cols = _read_int32(f)
+    data = numpy.frombuffer(f.read(rows * cols * dtype.itemsize), dtype=dtype)
+    return data.reshape(rows, cols)
+
+
+def read_ark(ark_path):
+    """
+    Generator over a binary Kaldi ark file.
+    @param ark_path: path to the ark
+    @return: yields (key, matrix) pairs in archive order
+    """
+    with open(ark_path, 'rb') as f:
+        while True:
+            key = b''
+            char = f.read(1)
+            while char and char != b' ':
+                key += char
+                char = f.read(1)
+            if not key:
+                break
+            yield key.decode('utf-8'), _read_matrix(f)
+
+
+def read_mat(rxfilename):
+    """
+    Reads a single matrix from an scp-style location, i.e. path/to/feats.ark:1234
+    """
+    path, offset = rxfilename.rsplit(':', 1)
+    with open(path, 'rb') as f:
+        f.seek(int(offset))
+        return _read_matrix(f)
+
+
+def read_scp(scp_path):
+    """
+    Generator over the matrices listed in an scp file.
+    @return: yields (key, matrix) pairs in scp order
+    """
+    with open(scp_path, 'r') as f:
+        for line in f:
+            key, rxfilename = line.rstrip('\n').split(' ', 1)
+            yield key, read_mat(rxfilename)
@@ -0,0 +1,152 @@
+"""
+Instrumentation of a run of the pipeline.
+
+Each stage of UtteranceController.forward, and each step of the work on an utterance within it
+(decode, resample, transform, encode, dlc, filter, write), records its wall time, CPU time, frames
+and bytes read and written. The totals, the peak RSS at the end of each stage and the per-utterance
+breakdown are written to a JSON run report, so runs can be compared. Like config, there is one
+report per process, which the tools record into.
+"""
+
+import contextlib
+import json
+import os
+import resource
+import sys
+import time
+
+COUNTERS = ['frames', 'bytes_read', 'bytes_written']
+
+
+def cpu_time():
+    """ CPU time of this process and its finished children, e.g. ffmpeg """
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return self_usage.ru_utime + self_usage.ru_stime + children.ru_utime + children.ru_stime
+
+
+def peak_rss_mb():
+    """ Peak resident set size of this process and of its largest child so far """
+    scale = 1024 ** 2 if sys.platform == 'darwin' else 1024  # ru_maxrss is in bytes on macOS, KB on Linux
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return peak / scale
+
+
+def empty_totals():
+    return dict({'wall': 0.0, 'cpu': 0.0, 'count': 0}, **{counter: 0 for counter in COUNTERS})
+
+
+class RunReport:
+    """ Stage and step timings of a run, with the per-utterance breakdown """
+    def __init__(self):
+        self.started = time.time()
+        self.stages = {}
+        self.utterances = {}
+        self.current = None
+        # in pool workers, steps are collected to be sent back to the main process rather than added
+        self.collecting = False
+        self.collected = []
+        self.last_progress = 0
+        self.stage_start = time.perf_counter()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """ Times a stage of the run; the steps recorded meanwhile are added to its breakdown """
+        self.current = name
+        record = self.stages.setdefault(name, {'wall': 0.0, 'cpu': 0.0, 'steps': {}})
+        wall, cpu = time.perf_counter(), cpu_time()
+        self.stage_start = wall
+        try:
+            yield record
+        finally:
+            record['wall'] += time.perf_counter() - wall
+            record['cpu'] += cpu_time() - cpu
+            record['peak_rss_mb'] = peak_rss_mb()
+            self.current = None
+
+    @contextlib.contextmanager
+    def step(self, name, utt_id=None):
+        """
+        Times one step of the work on an utterance. The caller adds what it processed to the record,
+        e.g. record['frames'] += n.
+        """
+        record = {counter: 0 for counter in COUNTERS}
+        wall, cpu = time.perf_counter(), cpu_time()
+        try:
+            yield record
+        finally:
+            record['wall'] = time.perf_counter() - wall
+            record['cpu'] = cpu_time() - cpu
+            if self.collecting:
+                self.collected.append((utt_id, name, record))
+            else:
+                self.add(utt_id, name, record)
+
+    def add(self, utt_id, name, record):
+        stage = self.stages.setdefault(self.current or 'other', {'wall': 0.0, 'cpu': 0.0, 'steps': {}})
+        totals = stage['steps'].setdefault(name, empty_totals())
+        totals['count'] += 1
+        for key in ['wall', 'cpu'] + COUNTERS:
+            totals[key] += record[key]
+        if utt_id is not None:
+            steps = self.utterances.setdefault(utt_id, {})
+            if name in steps:
+                record = {key: steps[name][key] + record[key] for key in record}
+            steps[name] = record
+
+    def take_collected(self):
+        """ The steps collected in a pool worker since the last call, to return to the main process """
+        collected, self.collected = self.collected, []
+        return collected
+
+    def merge(self, collected):
+        """ Adds the steps a pool worker collected """
+        for utt_id, name, record in collected:
+            self.add(utt_id, name, record)
+
+    def progress(self, label, done, total, interval=1.0):
+        """ Prints a progress line with the rate and ETA, at most every interval seconds """
+        now = time.perf_counter()
+        if done < total and now - self.last_progress < interval:
+            return
+        self.last_progress = now
+        elapsed = now - self.stage_start
+        rate = done / elapsed if elapsed > 0 else 0
+        eta = (total - done) / rate if rate > 0 else 0
+        line = (f'[{label}] {done}/{total} ({100 * done / max(total, 1):.0f}%) '
+                f'{rate:.2f} utt/s, ETA {time.strftime("%H:%M:%S", time.gmtime(eta))}')
+        if sys.stdout.isatty():
+            print('\r' + line, end='\n' if done >= total else '', flush=True)
+        else:
+            print(line, flush=True)
+
+    def summary(self):
+        lines = [f'{"stage/step":<24}{"wall s":>10}{"cpu s":>10}{"frames":>10}{"MB read":>10}{"MB written":>11}']
+        for name, stage in self.stages.items():
+            lines.append(f'{name:<24}{stage["wall"]:>10.1f}{stage["cpu"]:>10.1f}'
+                         f'{"":>31}  peak RSS {stage.get("peak_rss_mb", 0):.0f} MB')
+            for step, totals in stage['steps'].items():
+                lines.append(f'  {step:<22}{totals["wall"]:>10.1f}{totals["cpu"]:>10.1f}{totals["frames"]:>10}'
+                             f'{totals["bytes_read"] / 2 ** 20:>10.1f}{totals["bytes_written"] / 2 ** 20:>11.1f}')
+        return '\n'.join(lines)
+
+    def write(self, path):
+        """
+        Writes the report as JSON, creating its folder if need be. The report comes at the end of a run,
+        so a failure to write it is printed rather than raised.
+        @return: whether the report was written
+        """
+        try:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            with open(path, 'w') as f:
+                json.dump({'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+                           'wall': time.time() - self.started, 'cpu': cpu_time(), 'peak_rss_mb': peak_rss_mb(),
+                           'argv': sys.argv, 'stages': self.stages, 'utterances': self.utterances}, f, indent=1)
+        except OSError as error:
+            print(f'The run report could not be written to {path}: {error}')
+            return False
+        return True
+
+
+report = RunReport()
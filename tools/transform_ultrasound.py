@@ -9,7 +9,7 @@ Author: Aciel Eshky
 import math
 
 import numpy as np
-from scipy import ndimage
+from scipy import ndimage, sparse
 
 
 def cart2pol_vectorised(x, y):
@@ -115,3 +115,171 @@ def transform_ultrasound(ult, spline_interpolation_order=2, background_colour=25
                                                          cval=background_colour).transpose()
 
     return transformed_ult
+
+
+def spline_weights(coordinate, order):
+    """
+    Indices and weights of the B-spline coefficients which contribute to the value at each coordinate,
+    following the conventions of ndimage.map_coordinates.
+
+    :param coordinate: array of (fractional) positions along one axis
+    :param order: spline order, 1 to 3
+    :return: indices and weights, both of shape coordinate.shape + (order + 1,)
+    """
+    if order == 2:
+        start = np.floor(coordinate + 0.5) - 1
+        t = coordinate - (start + 1)
+        weights = [0.5 * (0.5 - t) ** 2, 0.75 - t ** 2, 0.5 * (0.5 + t) ** 2]
+    elif order in (1, 3):
+        start = np.floor(coordinate) - (order // 2)
+        t = coordinate - np.floor(coordinate)
+        if order == 1:
+            weights = [1 - t, t]
+        else:
+            weights = [(1 - t) ** 3 / 6, (4 - 6 * t ** 2 + 3 * t ** 3) / 6,
+                       (1 + 3 * t + 3 * t ** 2 - 3 * t ** 3) / 6, t ** 3 / 6]
+    else:
+        raise ValueError("Only spline interpolation orders 1 to 3 are supported.")
+    indices = start[..., np.newaxis].astype(np.int64) + np.arange(order + 1)
+    return indices, np.stack(weights, axis=-1)
+
+
+def mirror_indices(indices, length):
+    """ Reflects out of range indices back into [0, length) the way ndimage's mirror boundary does. """
+    if length == 1:
+        return np.zeros_like(indices)
+    period = 2 * (length - 1)
+    indices = np.abs(indices) % period
+    return np.where(indices >= length, period - indices, indices)
+
+
+class ScanConverter:
+    """
+    Precomputed version of transform_ultrasound for one probe geometry.
+
+    The spline interpolation of transform_ultrasound is linear in the (prefiltered) scanline data, so it is
+    stored once as a sparse matrix of gather weights. A whole (frames, scanlines, echos) block is then
+    prefiltered along both axes and converted with a single sparse product, instead of building the polar
+    coordinates and calling ndimage.map_coordinates again for every frame.
+    If a region is given, only the pixels of that crop of the output image are ever evaluated.
+    Use get_scan_converter to share converters between recordings with the same geometry.
+    """
+
+    def __init__(self, spline_interpolation_order=2, background_colour=255, num_scanlines=63, size_scanline=412,
+                 angle=0.038, zero_offset=50, pixels_per_mm=1, region=None):
+        """
+        Arguments are the same as transform_ultrasound, plus:
+        :param region: ((row_start, row_stop), (col_start, col_stop)) crop of the output image, where rows run
+                       along the depth and columns across the sector, i.e. the transpose of transform_ultrasound's
+                       (width, height) frames. Bounds are clipped to the canvas like slices. None keeps everything.
+        """
+        if pixels_per_mm == 0:
+            pixels_per_mm = 1
+            print("Zero value provided for resolution_multiplier. Value set to 1.")
+
+        if angle == 0:
+            angle = 0.038
+            print("Zero value provided for angle. Value set to 0.038.")
+
+        self.order = spline_interpolation_order
+        self.background_colour = background_colour
+        self.num_scanlines = num_scanlines
+        self.size_scanline = size_scanline
+
+        # same output canvas as transform_ultrasound
+        width = math.sqrt(math.pow(num_scanlines, 2) + math.pow(size_scanline, 2)) * 2 + zero_offset
+        height = size_scanline + zero_offset * 1.5
+        self.output_shape = (int(width // pixels_per_mm), int(height // pixels_per_mm))
+        origin = (int(self.output_shape[0] // 2), 0)
+
+        if region is None:
+            region = ((0, self.output_shape[1]), (0, self.output_shape[0]))
+        rows = range(self.output_shape[1])[slice(*region[0])]
+        cols = range(self.output_shape[0])[slice(*region[1])]
+        self.region_shape = (len(rows), len(cols))
+
+        xx, yy = np.meshgrid(np.array(cols), np.array(rows))
+        scanline_coord, echo_coord = get_cart2pol_coordinates_vectorised((xx, yy), origin=origin,
+                                                                        num_scanlines=num_scanlines, angle=angle,
+                                                                        zero_offset=zero_offset,
+                                                                        pixels_per_mm=pixels_per_mm)
+        scanline_coord = scanline_coord.ravel()
+        echo_coord = echo_coord.ravel()
+
+        # pixels outside the scanned sector take the background colour
+        inside = ((scanline_coord >= 0) & (scanline_coord <= num_scanlines - 1) &
+                  (echo_coord >= 0) & (echo_coord <= size_scanline - 1))
+        self.outside = ~inside
+        pixels = np.flatnonzero(inside)
+
+        scanline_idx, scanline_w = spline_weights(scanline_coord[pixels], self.order)
+        echo_idx, echo_w = spline_weights(echo_coord[pixels], self.order)
+        scanline_idx = mirror_indices(scanline_idx, num_scanlines)
+        echo_idx = mirror_indices(echo_idx, size_scanline)
+
+        taps = self.order + 1
+        columns = scanline_idx[:, :, np.newaxis] * size_scanline + echo_idx[:, np.newaxis, :]
+        weights = scanline_w[:, :, np.newaxis] * echo_w[:, np.newaxis, :]
+        rows = np.repeat(pixels, taps * taps)
+        self.weights = sparse.csr_matrix((weights.ravel(), (rows, columns.ravel())),
+                                         shape=(scanline_coord.size, num_scanlines * size_scanline))
+
+    def prefilter(self, ult):
+        """ Spline prefilter of every frame at once, as map_coordinates does for orders above 1 """
+        if self.order < 2:
+            return ult.astype(np.float64)
+        ult = ndimage.spline_filter1d(ult, self.order, axis=1, output=np.float64, mode='constant')
+        return ndimage.spline_filter1d(ult, self.order, axis=2, output=np.float64, mode='constant')
+
+    def convert(self, ult, dtype=np.float64, out=None, chunk_size=64):
+        """
+        Transforms ultrasound from raw to world, as images cropped to the converter's region.
+        Frames are converted chunk by chunk straight into the output buffer, so only one chunk of
+        float64 intermediates exists at a time.
+
+        :param ult: ultrasound data. 1d, 2d, and 3d shapes all accepted.
+        :param dtype: dtype of the output. Integer dtypes are rounded and clipped to their range.
+        :param out: optional preallocated output of shape (frames,) + region_shape
+        :param chunk_size: number of frames converted at a time
+        :return: 3 dimensional ultrasound of shape (frames, rows, columns). As with map_coordinates on integer
+                 input, values are rounded and clipped to the input's integer range.
+        """
+        ult = ult.reshape(-1, self.num_scanlines, self.size_scanline)
+        if out is None:
+            out = np.empty((ult.shape[0],) + self.region_shape, dtype=dtype)
+        round_to = [np.iinfo(t) for t in (ult.dtype, out.dtype) if np.issubdtype(t, np.integer)]
+
+        for start in range(0, ult.shape[0], chunk_size):
+            chunk = ult[start:start + chunk_size]
+            coefficients = self.prefilter(chunk).reshape(chunk.shape[0], -1)
+            transformed = (self.weights @ coefficients.T).T
+            transformed[:, self.outside] = self.background_colour
+            for info in round_to:
+                transformed = np.clip(np.rint(transformed), info.min, info.max)
+            out[start:start + chunk_size] = transformed.reshape((chunk.shape[0],) + self.region_shape)
+        return out
+
+    def __call__(self, ult):
+        """
+        Transforms ultrasound from raw to world, like transform_ultrasound.
+
+        :param ult: ultrasound data. 1d, 2d, and 3d shapes all accepted.
+        :return: 3 dimensional ultrasound of shape (frames, width, height) when no region is set.
+        """
+        return self.convert(ult).transpose(0, 2, 1)
+
+
+_scan_converters = {}
+
+
+def get_scan_converter(spline_interpolation_order=2, background_colour=255, num_scanlines=63, size_scanline=412,
+                       angle=0.038, zero_offset=50, pixels_per_mm=1, region=None):
+    """
+    Returns the ScanConverter for a probe geometry and region, building it the first time it is seen.
+    Arguments are the same as ScanConverter.
+    """
+    key = (spline_interpolation_order, background_colour, num_scanlines, size_scanline, angle, zero_offset,
+           pixels_per_mm, region)
+    if key not in _scan_converters:
+        _scan_converters[key] = ScanConverter(*key)
+    return _scan_converters[key]
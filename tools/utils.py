@@ -8,24 +8,66 @@ Author: M. Sam Ribeiro
 """
 
 from __future__ import print_function
-import skimage
+import numpy as np
+from scipy import ndimage
 
 
-def resize(data, target_frames):
-    ''' resize data stream '''
-    num_frames = data.shape[0]
-    x, y = data.shape[1], data.shape[2]
-    output_shape = (target_frames, x*y)
-
-    data = data.reshape(num_frames, -1)
-
-    resized = skimage.transform.resize(data, \
-        output_shape=output_shape, order=1, mode='edge', \
-        clip=True, preserve_range=True, anti_aliasing=True)
+def resample_frames(data, target_frames, anti_aliasing=True, dtype=np.float32, chunk_frames=16):
+    '''
+        change the frame rate of a (frames, ...) data stream, interpolating along time only
+        every pixel is interpolated at once, for one chunk of output frames at a time
 
-    resized = resized.reshape(-1, x, y)
-
-    return resized
+        output frame i is sampled at input time (i + 0.5) * frames / target_frames - 0.5,
+        linearly interpolated and held at the edges, as skimage.transform.resize does
+        anti_aliasing: gaussian low-pass along time before downsampling, with the same sigma as skimage
+        dtype: output dtype, integer types are rounded and clipped
+    '''
+    num_frames = data.shape[0]
+    resampled = np.empty((target_frames,) + data.shape[1:], dtype=dtype)
+    if target_frames == 0 or num_frames == 0:
+        return resampled
+
+    scale = num_frames / target_frames
+    sigma = (scale - 1) / 2 if anti_aliasing else 0
+    if sigma > 0:
+        radius = int(4.0 * sigma + 0.5)
+        kernel = np.exp(-0.5 * (np.arange(-radius, radius + 1) / sigma) ** 2)
+        kernel /= kernel.sum()
+    else:
+        radius = 0
+        kernel = np.ones(1)
+    offsets = np.arange(-radius, radius + 1)
+
+    for start in range(0, target_frames, chunk_frames):
+        positions = (np.arange(start, min(start + chunk_frames, target_frames)) + 0.5) * scale - 0.5
+        positions = np.clip(positions, 0, num_frames - 1)
+        lower = np.floor(positions).astype(np.int64)
+        upper = np.minimum(lower + 1, num_frames - 1)
+        weight = positions - lower
+
+        # the low-pass and the interpolation are both linear, so they are folded into one small
+        # (output frames, input frames) weight matrix, and every pixel is resampled by one product
+        first = max(lower[0] - radius, 0)
+        last = min(upper[-1] + radius + 1, num_frames)
+        weights = np.zeros((positions.size, last - first))
+        rows = np.arange(positions.size)[:, np.newaxis]
+        for taps, tap_weight in [(lower, 1 - weight), (upper, weight)]:
+            columns = np.clip(taps[:, np.newaxis] + offsets, 0, num_frames - 1) - first
+            np.add.at(weights, (rows, columns), tap_weight[:, np.newaxis] * kernel)
+
+        window = data[first:last].reshape(last - first, -1).astype(np.float32)
+        chunk = weights.astype(np.float32) @ window
+        if np.issubdtype(dtype, np.integer):
+            info = np.iinfo(dtype)
+            chunk = np.clip(np.rint(chunk), info.min, info.max)
+        resampled[start:start + positions.size] = chunk.reshape((positions.size,) + data.shape[1:])
+
+    return resampled
+
+
+def resize(data, target_frames, dtype=np.float32):
+    ''' resize data stream along time '''
+    return resample_frames(data, target_frames, anti_aliasing=True, dtype=dtype)
 
 
 